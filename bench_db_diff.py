@@ -0,0 +1,141 @@
+'''
+Benchmark the db_diff core on generated row counts
+
+    tables * days rows per database
+    time and peak memory of
+        join: the former per-column groupby-aggregate-join diff on csv
+        csv: db_diff.compare on csv
+        parquet: db_diff.compare on parquet
+'''
+
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import db_diff
+
+
+def make_counts(no_tables, no_days, out_dir):
+    '''
+    write rs, bq and partition files as csv and parquet
+    bq misses 1% of the rows of every 10th day
+    '''
+    days = pd.date_range('2017-01-01', periods=no_days, freq='D')
+    tables = ['table_{id:04d}'.format(id=t) for t in range(no_tables)]
+    rng = np.random.default_rng(42)
+
+    df_rs = pd.DataFrame({
+        'tablename': np.repeat(tables, no_days),
+        'on_day': np.tile(days.strftime('%Y-%m-%d'), no_tables),
+        'total_rows': rng.integers(1000, 1000000, size=no_tables*no_days),
+        })
+    df_bq = df_rs.copy()
+    lossy = np.arange(len(df_bq)) % 10 == 0
+    df_bq.loc[lossy, 'total_rows'] = (df_bq.loc[lossy, 'total_rows'] * 0.99).astype(np.int64)
+    df_part = pd.DataFrame({
+        'tablename': df_rs.tablename,
+        'on_day': np.tile(days.strftime('%Y%m%d').astype(int), no_tables),
+        })
+
+    files = {}
+    for name, df in [('rs', df_rs), ('bq', df_bq), ('part', df_part)]:
+        csv_file = os.path.join(out_dir, '{name}.csv'.format(name=name))
+        parquet_file = os.path.join(out_dir, '{name}.parquet'.format(name=name))
+        df.to_csv(csv_file, header=False, index=False)
+        df.to_parquet(parquet_file, index=False)
+        files[name] = (csv_file, parquet_file)
+    return files
+
+
+def _join_load(count_file):
+    df = pd.read_csv(count_file, header=None,
+            names=['tablename', 'on_day', 'total_rows'])
+    df['on_day'] = df['on_day'].str.replace('-', '')
+    df['on_day'] = pd.to_numeric(df['on_day'])
+    return df.set_index(['tablename', 'on_day'])
+
+
+def join_compare(rs_file, bq_file, partition_file):
+    '''
+    the diff before the columnar rewrite
+    '''
+    df_rs = _join_load(rs_file)
+    df_bq = _join_load(bq_file)
+    df_part = pd.read_csv(partition_file, header=None,
+                          names=['tablename', 'on_day'])
+    df_part = df_part.set_index(['tablename', 'on_day'])
+    df_part['is_part'] = 1
+    df_bq = df_bq.join(df_part)
+
+    df_cmp = df_rs.join(df_bq, lsuffix='_rs', rsuffix='_bq')
+    df_cmp['absolute_diff'] = df_cmp.total_rows_bq - df_cmp.total_rows_rs
+    df_cmp['relative_diff'] = (df_cmp.absolute_diff *100.0) \
+                               / df_cmp.total_rows_rs
+
+    groups = df_cmp.groupby(level=0)
+    table_total = groups['total_rows_rs'].aggregate('sum')
+    df_cmp['total_table_rs'] = df_cmp.join(table_total,
+                                           rsuffix='_table')['total_rows_rs_table']
+
+    table_total = groups['total_rows_bq'].aggregate('sum')
+    df_cmp['total_table_bq'] = df_cmp.join(table_total,
+                                           rsuffix='_table')['total_rows_bq_table']
+
+    table_parts = groups['total_rows_rs'].count()
+    df_cmp['no_days'] = df_cmp.join(table_parts,
+                                     rsuffix='_part')['total_rows_rs_part']
+
+    df_cmp['relative_table_diff'] = (df_cmp.absolute_diff *100.0) \
+                                     / df_cmp.total_table_rs
+    return df_cmp
+
+
+def measure(name, f_compare, *files):
+    tracemalloc.start()
+    start = time.perf_counter()
+    df_cmp = f_compare(*files)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{name:8} {secs:8.2f} s {peak:8.1f} MiB  diff_total={diff}".format(
+            name=name, secs=elapsed, peak=peak / 2**20,
+            diff=int(df_cmp.absolute_diff.sum())))
+
+
+def main(options):
+    no_tables = int(options['--tables'])
+    no_days = int(options['--days'])
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        files = make_counts(no_tables, no_days, out_dir)
+        csv_files = [files[name][0] for name in ['rs', 'bq', 'part']]
+        parquet_files = [files[name][1] for name in ['rs', 'bq', 'part']]
+
+        print("{tables} tables x {days} days".format(tables=no_tables, days=no_days))
+        measure('join', join_compare, *csv_files)
+        measure('csv', db_diff.compare, *csv_files)
+        measure('parquet', db_diff.compare, *parquet_files)
+
+
+_usage="""
+Benchmark the db_diff core
+
+Usage:
+  bench_db_diff [--tables=<t>] [--days=<d>]
+
+Options:
+  -h --help       show this
+  --tables=<t>    number of tables [default: 1000]
+  --days=<d>      number of days per table [default: 1000]
+"""
+
+from docopt import docopt
+
+
+if __name__ == '__main__':
+    options = docopt(_usage)
+    main(options)
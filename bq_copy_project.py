@@ -2,7 +2,10 @@
 copy BigQuery Tables to another project
 
 the copy preserves all DAY partitions
-processes the tables sequentially
+processes the tables sequentially, the partitions of a table in parallel
+a sync compares the partition summaries and copies only what changed
+tables partitioned on their time column are loaded in batches of days
+they have no _PARTITIONTIME, db_count, db_tables and db_dist read them only with --unpruned
 '''
 from google.cloud import bigquery
 from bq_lib import *
@@ -21,17 +24,24 @@ def src_configure(settings):
 
     copy = lambda : True
 
+    # the project of the credentials, dev and prod settings name the same project
+    read_partition_summary = make_read_partition_summary(client, dataset.project,
+                                                         settings['dataset'])
+
     insert_select = make_insert_select(client)
-    make_insert_data = make_make_insert_data(insert_select)
+    copy_partition = make_copy_partition(client)
+    make_insert_data = make_make_insert_data(insert_select, copy_partition)
     load = make_load(make_insert_data)
 
-    return {'list_tables': list_tables,
+    return {'dataset': dataset,
+            'list_tables': list_tables,
+            'read_partition_summary': read_partition_summary,
             'load': load,
             'copy': copy
            }
 
 
-def dest_configure(settings):
+def dest_configure(settings, time_column=None, cluster_columns=(), batch_days=31):
     client = bigquery.Client.from_service_account_json(settings['gcp_cfg'])
     dataset = client.dataset(settings['dataset'])
 
@@ -43,15 +53,36 @@ def dest_configure(settings):
     list_tables = make_list_tables(dataset, table_filter)
 
     rename = lambda x: x
-    copy_table = make_copy_table(dataset, [], rename)
+    copy_table = make_copy_table(dataset, [], rename, time_column, cluster_columns)
     copy = make_copy(copy_table)
 
     insert_select = make_insert_select(client)
-    make_insert_data = make_make_insert_data(insert_select)
+    copy_partition = make_copy_partition(client)
+    # a load into a table with rows fails, a rerun needs --replace or --run
+    insert_days = make_insert_days(client, write_disposition='WRITE_EMPTY')
+    make_insert_data = make_make_insert_data(insert_select, copy_partition,
+                                             insert_days, batch_days)
     load = make_load(make_insert_data)
 
-    return {'list_tables': list_tables,
+    # the project of the credentials, dev and prod settings name the same project
+    read_partition_summary = make_read_partition_summary(client, dataset.project,
+                                                         settings['dataset'])
+    replace_select = make_insert_select(client, write_disposition='WRITE_TRUNCATE')
+    replace_partition = make_copy_partition(client, write_disposition='WRITE_TRUNCATE')
+    replace_days = make_insert_days(client, write_disposition='WRITE_TRUNCATE')
+    make_replace_data = make_make_insert_data(replace_select, replace_partition,
+                                              replace_days, batch_days)
+    replace = make_load(make_replace_data)
+
+    return {'dataset': dataset,
+            'copy_table': copy_table,
+            'read_partition_summary': read_partition_summary,
+            'replace_select': replace_select,
+            'replace_partition': replace_partition,
+            'make_replace_data': make_replace_data,
+            'list_tables': list_tables,
             'load': load,
+            'replace': replace,
             'copy': copy
            }
 
@@ -65,6 +96,7 @@ def configure(options):
                             'weather_hist'],
                 'project': 'zephyrus-ef4-prod-ostro',
                 'dataset': 'ostro',
+                'time_column': 'timestamp',
                 },
             'ostro': {
                 'gcp_cfg': './etc/prod-ostro/gcp.json',
@@ -73,6 +105,7 @@ def configure(options):
                             'weather_hist'],
                 'project': 'zephyrus-ef4-prod-ostro',
                 'dataset': 'ostro',
+                'time_column': 'timestamp',
                 } 
             }
 
@@ -80,7 +113,28 @@ def configure(options):
     src_config = src_configure(config[game])
 
     game = options['DESTINATION']
-    dest_config = dest_configure(config[game])
+    if options['--by-time']:
+        time_column = config[game]['time_column']
+    else:
+        time_column = None
+    cluster_columns = [c for c in (options['--cluster'] or '').split(',') if c]
+    dest_config = dest_configure(config[game], time_column, cluster_columns,
+                                 int(options['--batch']))
+
+    steps = make_copy_steps(src_config['dataset'], dest_config['dataset'],
+                            dest_config['copy_table'], lambda x: x,
+                            dest_config['make_replace_data'])
+    state_file = "bq_{source}_to_{dest}_steps.csv".format(
+                    source=options['SOURCE'], dest=options['DESTINATION'])
+    dest_config['run_steps'] = make_run_steps(steps, state_file)
+
+    dest_config['sync'] = make_sync(src_config['read_partition_summary'],
+                                    dest_config['read_partition_summary'],
+                                    dest_config['dataset'], dest_config['copy_table'],
+                                    lambda x: x,
+                                    dest_config['replace_select'],
+                                    dest_config['replace_partition'],
+                                    time_column)
 
     return src_config, dest_config
 
@@ -94,9 +148,19 @@ def main(options):
 
     if options['--copy']:
         dest_tables = dest['copy'](all_tables)
+    elif options['--load'] and options['--replace']:
+        dest_tables = dest['list_tables']()
+        dest['replace'](dest_tables, all_tables)
     elif options['--load']:
         dest_tables = dest['list_tables']()
         dest['load'](dest_tables, all_tables)
+    elif options['--run']:
+        failed = dest['run_steps']([table.name for table in all_tables])
+        for table_name, steps in failed:
+            log_info("{table} stopped, not done: {steps}".format(
+                        table=table_name, steps=','.join(steps)))
+    elif options['--sync']:
+        dest['sync'](all_tables)
     elif options['--drop']:
         dest_tables = dest['list_tables']()
         drop(dest_tables)
@@ -109,17 +173,25 @@ Copy BigQuery tables to another project.
 Preserve all DAY partitions.
 
 Usage:
-  bq_copy_project (--copy | --load | --drop) SOURCE DESTINATION
+  bq_copy_project (--copy | --load [--replace] | --run | --sync | --drop) [--by-time [--cluster=<c>]] [--batch=<d>] SOURCE DESTINATION
 
 Arguments:
   SOURCE      name of the project
   DESTINATION name of the project
 
 Options:
-  -h --help  show this
-  --copy     create copies of all tables in DESTINATION
-  --load     load the data into DESTINATION tables
-  --drop     drop all tables in DESTINATION
+  -h --help      show this
+  --copy         create copies of all tables in DESTINATION
+  --load         load the data into DESTINATION tables, a table partitioned
+                 on its time column must be empty
+  --replace      replace the partitions of the DESTINATION tables, a rerun does not duplicate rows
+  --run          create, load and verify per table, a rerun continues where the last run stopped
+  --sync         replace only the partitions which are missing or changed in DESTINATION
+  --drop         drop all tables in DESTINATION
+  --by-time      create the tables partitioned on their time column, not on the ingestion time,
+                 the db_ tools read these tables only with --unpruned
+  --cluster=<c>  cluster the created tables on these comma separated columns
+  --batch=<d>    load tables partitioned on their time column in batches of d days [default: 31]
 """
 
 from docopt import docopt
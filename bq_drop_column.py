@@ -3,9 +3,10 @@ operations on BigQuery Tables
     drop a column
     make a backup copy or copy
     restore from a backup copy
+    drop columns in one rewrite
 
 the operations preserve all DAY partitions
-processes the tables sequentially
+processes the tables sequentially, the partitions of a table in parallel
 '''
 from google.cloud import bigquery
 from bq_lib import *
@@ -31,6 +32,66 @@ def make_reverse_rename(suffix, separator='_'):
     return reverse_rename
 
 
+def plan_drop_columns(tables, columns):
+    '''
+    the tables with at least one of the columns
+    and the columns dropped from each
+    '''
+    plan = []
+    for table in tables:
+        drop_columns = [field.name for field in table.schema if field.name in columns]
+        if drop_columns:
+            plan.append((table, drop_columns))
+    return plan
+
+
+def make_rewrite(dataset, snapshot, recreate, make_insert_data, separator, appendix):
+    '''
+    one rewrite of the data per table
+        copy job of the table to the backup, no bytes are billed
+        |> drop the table
+        |> create the table without the columns
+        |> INSERT-SELECT all partitions from the backup
+    the backup stays until --clean
+    '''
+    def rewrite(table):
+        backup = dataset.table(separator.join([table.name, appendix]))
+        log_info("snapshot {table} to {backup}".format(table=table.name, backup=backup.name))
+        snapshot(backup, table).result()
+        backup.reload()
+
+        table.delete()
+        new_table = recreate(table)
+        insert_data = make_insert_data(backup)
+        insert_data(new_table, backup)
+        return new_table
+    return rewrite
+
+
+def make_swap_steps(dataset, copy_partition, rename):
+    '''
+    steps after the copy is loaded and verified
+        swap: check the copy, drop the table, copy job of the copy to the table name
+        |> clean: drop the copy
+    '''
+    def swap(table_name):
+        # a missing copy raises here, before the table is dropped
+        copy = dataset.table(rename(table_name))
+        copy.reload()
+        table = dataset.table(table_name)
+        if table.exists():
+            table.delete()
+        copy_partition(table, copy).result()
+
+    def clean(table_name):
+        copy = dataset.table(rename(table_name))
+        if copy.exists():
+            copy.delete()
+
+    return [('swap', swap, ['verify']),
+            ('clean', clean, ['swap'])]
+
+
 def build_copy(dataset, exclude_columns, separator, appendix):
     rename = lambda x: separator.join([x, appendix])
     copy_table = make_copy_table(dataset, exclude_columns, rename)
@@ -52,6 +113,7 @@ def configure(options):
     any_copy = make_any_copy(reserved_suffix, separator)
 
     game = options['PROJECT']
+    drop_columns = options['--columns'].split(',')
 
     config = {
         'bora': {
@@ -73,7 +135,7 @@ def configure(options):
             } 
        }
 
-    settings = cnfig[game]
+    settings = config[game]
     gcp_cfg = './etc/{proj}/gcp.json'.format(proj=game)
 
     client = bigquery.Client.from_service_account_json(gcp_cfg)
@@ -92,18 +154,37 @@ def configure(options):
     table_filter = make_filter_tables(f_filter)
     list_tables = make_list_tables(dataset, table_filter)
 
-    copy, reverse_copy = build_copy(dataset, ['insertid'], '_', 'copy')
+    copy, reverse_copy = build_copy(dataset, drop_columns, '_', 'copy')
     backup, reverse_backup = build_copy(dataset, [], '_', 'backup')
 
     insert_select = make_insert_select(client)
-    make_insert_data = make_make_insert_data(insert_select)
+    copy_partition = make_copy_partition(client)
+    make_insert_data = make_make_insert_data(insert_select, copy_partition)
     load = make_load(make_insert_data)
+    make_replace_data = make_make_insert_data(
+                            make_insert_select(client, write_disposition='WRITE_TRUNCATE'),
+                            make_copy_partition(client, write_disposition='WRITE_TRUNCATE'))
+
+    rename = lambda x: separator.join([x, 'copy'])
+    steps = make_copy_steps(dataset, dataset,
+                            make_copy_table(dataset, drop_columns, rename), rename,
+                            make_replace_data) \
+          + make_swap_steps(dataset, copy_partition, rename)
+    state_file = "bq_{game}_drop_{columns}_steps.csv".format(
+                    game=game, columns='_'.join(drop_columns))
+    run_steps = make_run_steps(steps, state_file)
+
+    recreate = make_copy_table(dataset, drop_columns, lambda x: x)
+    rewrite = make_rewrite(dataset, copy_partition, recreate, make_insert_data,
+                           separator, 'backup')
 
     return {'is_copy': is_copy, 'is_any_copy': is_any_copy,
             'is_backup': is_backup,
             'list_tables': list_tables, 'load': load,
             'copy': copy, 'reverse_copy': reverse_copy,
             'backup': backup, 'reverse_backup': reverse_backup,
+            'drop_columns': drop_columns, 'rewrite': rewrite,
+            'run_steps': run_steps,
            }
 
 
@@ -147,6 +228,22 @@ def main(options):
         tables = [table for table in all_tables
                   if not is_any_copy(table.name)]
         drop(tables)
+    elif options['--rewrite']:
+        tables = [table for table in all_tables
+                  if not is_any_copy(table.name)]
+        plan = plan_drop_columns(tables, inject['drop_columns'])
+        for table, columns in plan:
+            log_info("drop {columns} from {table}".format(columns=','.join(columns), table=table.name))
+        for table, _ in plan:
+            inject['rewrite'](table)
+    elif options['--run']:
+        tables = [table for table in all_tables
+                  if not is_any_copy(table.name)]
+        plan = plan_drop_columns(tables, inject['drop_columns'])
+        failed = inject['run_steps']([table.name for table, _ in plan])
+        for table_name, steps in failed:
+            log_info("{table} stopped, not done: {steps}".format(
+                        table=table_name, steps=','.join(steps)))
     elif options['--clean']:
         tables = [table for table in all_tables
                   if is_any_copy(table.name)]
@@ -159,19 +256,23 @@ _usage="""
 Perform the requested operation on BigQuery tables
 
 Usage:
-  bq_drop_column (--backup | --undo | --copy | --drop | --reverse | --clean) PROJECT
+  bq_drop_column (--backup | --undo | --copy | --drop | --reverse | --rewrite | --run | --clean) [--columns=<c>] PROJECT
 
 Arguments:
   PROJECT    name of the project
 
 Options:
-  -h --help  show this
-  --backup   create backup copies of all tables
-  --undo     put the backup copies in place
-  --copy     create copies of all tables
-  --drop     drop all tables not a copy or a backup
-  --reverse  put the copies in place
-  --clean    drop all backup copies and copies
+  -h --help      show this
+  --backup       create backup copies of all tables
+  --undo         put the backup copies in place
+  --copy         create copies of all tables
+  --drop         drop all tables not a copy or a backup
+  --reverse      put the copies in place
+  --rewrite      drop the columns in one pass, keeps a backup copy
+  --run          copy without the columns, verify, swap and clean per table,
+                 a rerun continues where the last run stopped
+  --clean        drop all backup copies and copies
+  --columns=<c>  comma-separated columns to drop [default: insertid]
 """
 
 from docopt import docopt
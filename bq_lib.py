@@ -1,3 +1,7 @@
+from concurrent.futures import Future
+import collections
+import datetime
+import threading
 import uuid
 import time
 
@@ -13,11 +17,22 @@ def is_partitioned(table):
     else: return False
 
 
+def is_column_partitioned(table):
+    '''
+    DAY partitions on a time column instead of the ingestion time
+    '''
+    return bool(table._properties.get('timePartitioning', {}).get('field'))
+
+
 def is_daily(table):
     if 'timestamp' in [c.name for c in table.schema]: return True
     else: False
 
 
+def has_column(schema, column):
+    return column is not None and column in [c.name for c in schema]
+
+
 def has_schema(table):
     if table.schema: return True
     else: False
@@ -41,30 +56,269 @@ def drop(tables):
         table.delete()
 
 
-def copy_data(client, dest, source):
+def make_submit_job(max_jobs=50, first_wait=0.5, max_wait=10.0, backoff=1.5):
+    '''
+    run copy, query and load jobs at the same time
+    submit_job(job) |> Future with the finished job
+
+    at most max_jobs jobs of a project are running, the others wait
+    one thread polls all running jobs
+    a job is polled after first_wait seconds, then backoff times later
+    than before, up to max_wait
+    '''
+    cond = threading.Condition()
+    queued = collections.deque()
+    running = []
+    active = collections.Counter()
+    poller = []
+
+    def project_of(job):
+        return getattr(job, 'project', None)
+
+    def finish(entry, error=None):
+        with cond:
+            running.remove(entry)
+            active[project_of(entry['job'])] -= 1
+            cond.notify()
+        if error is not None:
+            entry['future'].set_exception(error)
+        else:
+            entry['future'].set_result(entry['job'])
+
+    def take_startable():
+        '''
+        with the lock held, the queued jobs of projects with a free slot
+        the slot is taken before the job begins
+        '''
+        startable = []
+        waiting = len(queued)
+        for _ in range(waiting):
+            job, future = queued.popleft()
+            if active[project_of(job)] >= max_jobs:
+                queued.append((job, future))
+                continue
+            active[project_of(job)] += 1
+            startable.append((job, future))
+        return startable
+
+    def start(startable):
+        # begin is an API call, it runs without the lock
+        for job, future in startable:
+            try:
+                job.begin()
+            except Exception as error:
+                with cond:
+                    active[project_of(job)] -= 1
+                future.set_exception(error)
+                continue
+            with cond:
+                running.append({'job': job, 'future': future,
+                                'wait': first_wait, 'next_poll': time.time() + first_wait})
+
+    def poll():
+        while True:
+            with cond:
+                startable = take_startable()
+                while not running and not startable:
+                    cond.wait()
+                    startable = take_startable()
+            start(startable)
+
+            with cond:
+                if not running:
+                    continue
+                now = time.time()
+                due = [entry for entry in running if entry['next_poll'] <= now]
+                if not due:
+                    cond.wait(min(entry['next_poll'] for entry in running) - now)
+                    continue
+
+            for entry in due:
+                job = entry['job']
+                try:
+                    job.reload()
+                except Exception as error:
+                    finish(entry, error)
+                    continue
+                if job.state == 'DONE':
+                    if job.error_result:
+                        finish(entry, RuntimeError("job {job_id} failed: {error}".format(
+                                                    job_id=job.name, error=job.error_result)))
+                    else:
+                        finish(entry)
+                else:
+                    entry['wait'] = min(entry['wait'] * backoff, max_wait)
+                    entry['next_poll'] = time.time() + entry['wait']
+
+    def submit_job(job):
+        future = Future()
+        with cond:
+            queued.append((job, future))
+            if not poller:
+                poller.append(threading.Thread(target=poll, daemon=True))
+                poller[0].start()
+            cond.notify()
+        return future
+    return submit_job
+
+
+_submit_job = make_submit_job()
+
+
+def copy_data(client, dest, source, submit_job=_submit_job):
     '''
     only works when schema of source and destination are identical
     all data is inserted into _current_ day partition
     '''
     job = client.copy_table(_job_id(), dest, source)
-    job.begin()
-    retry_count = 100
-    while retry_count > 0 and job.state != 'DONE':
-        retry_count -= 1
-        time.sleep(10)
-        job.reload()
+    return submit_job(job).result()
+
+
+def _date(day):
+    day = str(day).replace('-', '')
+    return datetime.date(int(day[:4]), int(day[4:6]), int(day[6:8]))
+
+
+def make_partition_filter_sql(slack_days=0, unpruned=False):
+    '''
+    _PARTITIONTIME range of the days, slack_days wider on both ends
+    for the rows which are not in the partition of their day
+    the same literals work in legacy and standard SQL
+    unpruned is for tables without partitions
+    and for tables partitioned on a column, they have no _PARTITIONTIME
+    '''
+    def partition_filter_sql(start_day, end_day):
+        if unpruned:
+            return ""
+        slack = datetime.timedelta(days=slack_days)
+        return """
+            AND _PARTITIONTIME BETWEEN TIMESTAMP('{start}')
+                                   AND TIMESTAMP('{end}')
+            """.format(start=(_date(start_day) - slack).isoformat(),
+                       end=(_date(end_day) + slack).isoformat())
+    return partition_filter_sql
+
+
+def make_check_pruned(unpruned=False):
+    '''
+    refuse a query which would scan all partitions of a table
+    '''
+    def check_pruned(sql, table):
+        if not unpruned and '_PARTITIONTIME' not in sql:
+            raise RuntimeError(
+                "query on {table} has no _PARTITIONTIME filter and scans all partitions, "
+                "allow it with --unpruned".format(table=table))
+    return check_pruned
+
+
+def make_estimate_bytes(client):
+    def estimate_bytes(sql, legacy=False):
+        '''
+        dry run of a query, nothing is billed
+        '''
+        job_data = {
+            "jobReference": {
+              "projectId": client.project,
+              "jobId": "{jobid}".format(jobid=_job_id())
+            },
+            "configuration": {
+              "dryRun": "True",
+              "query": {
+                 "query": "{query}".format(query=sql),
+                 "useLegacySql": legacy
+              }
+            }
+        }
+        job = client.job_from_resource(job_data)
+        job.begin()
+        return int(job._properties['statistics']['totalBytesProcessed'])
+    return estimate_bytes
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+def make_cost_guard(estimate_bytes, budget=None):
+    '''
+    dry run every query and record its bytes per stage and table
+    check(sql, stage, table) |> maximum bytes billed of the query job
+
+    a query which would take the run over the budget raises BudgetExceeded
+    and so does every query after it, the run stops scheduling
+    the cap of a job is what is left of the budget
+    '''
+    lock = threading.Lock()
+    spent = collections.Counter()
+    exceeded = []
+
+    def check(sql, stage, table, legacy=False):
+        if exceeded:
+            raise BudgetExceeded(exceeded[0])
+        estimated = estimate_bytes(sql, legacy)
+        with lock:
+            total = sum(spent.values())
+            if budget is not None and total + estimated > budget:
+                exceeded.append(
+                    "{stage} {table} scans {estimated} bytes, {left} bytes are left of the budget, "
+                    "read fewer days or columns".format(
+                        stage=stage, table=table, estimated=estimated, left=budget - total))
+                raise BudgetExceeded(exceeded[0])
+            spent[(stage, table)] += estimated
+        if budget is None:
+            return None
+        return budget - total
+
+    def report():
+        with lock:
+            return sorted((stage, table, estimated)
+                          for (stage, table), estimated in spent.items())
+    return {'check': check, 'report': report}
+
+
+def make_budget_guard(client, budget_gb):
+    '''
+    only a run with a budget dry runs its queries
+    '''
+    if not budget_gb:
+        return None
+    return make_cost_guard(make_estimate_bytes(client), int(float(budget_gb) * 1024**3))
+
+
+def write_cost_report(cost_guard, csv_out):
+    '''
+    csv with stage,table,estimated_bytes
+    '''
+    import csv
+    rows = cost_guard['report']()
+    per_stage = collections.Counter()
+    for stage, _, estimated in rows:
+        per_stage[stage] += estimated
+    for stage, estimated in sorted(per_stage.items()):
+        log_info("{stage} scans {gb:.2f} GB".format(stage=stage, gb=estimated / 1024**3))
+    with open(csv_out, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
 
+def _partition_id(table_name, partition):
+    if partition is None:
+        return table_name
+    return ''.join([table_name, "$", partition])
 
-def make_insert_select(client):
-    def insert_select(dest, source):
+
+def make_insert_select(client, submit_job=_submit_job, cost_guard=None, write_disposition=None):
+    def insert_select(dest, source, partition=None):
         '''
         use INSERT-SELECT to copy data from source to destination
+        returns a Future of the query job
+        with a cost guard the job is capped at what is left of the budget
+        WRITE_TRUNCATE replaces the destination partition instead of appending
         '''
         columns = ','.join([c.name for c in dest.schema])
         query = """
         SELECT {columns}
         FROM [{table}]
-        """.format(table=source.select_id, columns=columns)
+        """.format(table=_partition_id(source.table_id, partition), columns=columns)
 
         job_data = {
             "jobReference": {
@@ -78,34 +332,205 @@ def make_insert_select(client):
                  "destinationTable": {
                     "projectId": "{project}".format(project=dest.project),
                     "datasetId": "{dataset}".format(dataset=dest.dataset_name),
-                    "tableId": "{table}".format(table=dest.insert_id)
+                    "tableId": "{table}".format(table=_partition_id(dest.name, partition))
                  }
               }
             }
         }
+        if write_disposition is not None:
+            job_data["configuration"]["query"]["writeDisposition"] = write_disposition
+        if cost_guard is not None:
+            max_bytes = cost_guard['check'](query, 'insert_select',
+                                            _partition_id(source.name, partition), legacy=True)
+            if max_bytes is not None:
+                job_data["configuration"]["query"]["maximumBytesBilled"] = str(max_bytes)
 
         job = client.job_from_resource(job_data)
-        job.begin()
-        return job.result()
+        return submit_job(job)
     return insert_select
 
 
-def make_make_insert_data(do_insert_select):
+def batch_partitions(partitions, batch_days):
+    '''
+    consecutive partitions in batches of at most batch_days
+    |> [(first_partition, last_partition), ..]
+    '''
+    partitions = sorted(partitions)
+    return [(partitions[i], partitions[min(i + batch_days, len(partitions)) - 1])
+            for i in range(0, len(partitions), batch_days)]
+
+
+def make_insert_days(client, submit_job=_submit_job, cost_guard=None, write_disposition=None):
+    def insert_days(dest, source, batches):
+        '''
+        one INSERT-SELECT per batch of days into the whole destination table
+        BigQuery writes the rows into the partitions of their time column
+        returns the Futures of the query jobs
+
+        the first batch runs alone with write_disposition,
+        WRITE_TRUNCATE replaces the table, WRITE_EMPTY refuses a table with rows,
+        the others append at the same time after it
+        a failed batch logs its range of days
+        standard SQL, legacy SQL can not write into column partitioned tables
+        '''
+        columns = ','.join([c.name for c in dest.schema])
+
+        def submit(first_partition, last_partition, disposition):
+            query = """
+            SELECT {columns}
+            FROM `{project}.{dataset}.{table}`
+            WHERE _PARTITIONTIME BETWEEN TIMESTAMP('{first_day}')
+                                     AND TIMESTAMP('{last_day}')
+            """.format(columns=columns, project=source.project,
+                       dataset=source.dataset_name, table=source.name,
+                       first_day=_date(first_partition).isoformat(),
+                       last_day=_date(last_partition).isoformat())
+
+            job_data = {
+                "jobReference": {
+                  "projectId": dest.project,
+                  "jobId": "{jobid}".format(jobid=_job_id())
+                },
+                "configuration": {
+                  "query": {
+                     "query": "{query}".format(query=query),
+                     "useLegacySql": False,
+                     "destinationTable": {
+                        "projectId": "{project}".format(project=dest.project),
+                        "datasetId": "{dataset}".format(dataset=dest.dataset_name),
+                        "tableId": "{table}".format(table=dest.name)
+                     }
+                  }
+                }
+            }
+            if disposition is not None:
+                job_data["configuration"]["query"]["writeDisposition"] = disposition
+            if cost_guard is not None:
+                max_bytes = cost_guard['check'](query, 'insert_days', ''.join(
+                                [source.name, "$", first_partition, "-", last_partition]))
+                if max_bytes is not None:
+                    job_data["configuration"]["query"]["maximumBytesBilled"] = str(max_bytes)
+
+            job = client.job_from_resource(job_data)
+            return submit_job(job)
+
+        def log_failed(first_partition, last_partition):
+            def log(future):
+                if future.exception() is not None:
+                    log_info("insert {source} {first}..{last} into {dest} failed: {error}".format(
+                                source=source.name, first=first_partition, last=last_partition,
+                                dest=dest.name, error=future.exception()))
+            return log
+
+        if not batches:
+            return []
+        first = submit(batches[0][0], batches[0][1], write_disposition)
+        try:
+            first.result()
+        except Exception:
+            log_failed(*batches[0])(first)
+            log_info("{count} batches of {source} not started".format(
+                        count=len(batches) - 1, source=source.name))
+            raise
+        futures = [first]
+        for first_partition, last_partition in batches[1:]:
+            future = submit(first_partition, last_partition, 'WRITE_APPEND')
+            future.add_done_callback(log_failed(first_partition, last_partition))
+            futures.append(future)
+        return futures
+    return insert_days
+
+
+def make_copy_partition(client, submit_job=_submit_job, write_disposition=None):
+    def copy_partition(dest, source, partition=None):
+        '''
+        use a copy job, no bytes are billed
+        only works when schema of source and destination are identical
+        returns a Future of the copy job
+        WRITE_TRUNCATE replaces the destination partition instead of appending
+        '''
+        job_data = {
+            "jobReference": {
+              "projectId": dest.project,
+              "jobId": "{jobid}".format(jobid=_job_id())
+            },
+            "configuration": {
+              "copy": {
+                 "sourceTable": {
+                    "projectId": "{project}".format(project=source.project),
+                    "datasetId": "{dataset}".format(dataset=source.dataset_name),
+                    "tableId": "{table}".format(table=_partition_id(source.name, partition))
+                 },
+                 "destinationTable": {
+                    "projectId": "{project}".format(project=dest.project),
+                    "datasetId": "{dataset}".format(dataset=dest.dataset_name),
+                    "tableId": "{table}".format(table=_partition_id(dest.name, partition))
+                 }
+              }
+            }
+        }
+        if write_disposition is not None:
+            job_data["configuration"]["copy"]["writeDisposition"] = write_disposition
+
+        job = client.job_from_resource(job_data)
+        return submit_job(job)
+    return copy_partition
+
+
+def same_schema(dest, source):
+    return [(f.name, f.field_type, f.mode) for f in dest.schema] == \
+           [(f.name, f.field_type, f.mode) for f in source.schema]
+
+
+def wait_all(futures):
+    '''
+    wait for all futures, then raise the first error
+    '''
+    errors = [future.exception() for future in futures]
+    errors = [error for error in errors if error is not None]
+    if errors:
+        raise errors[0]
+    return [future.result() for future in futures]
+
+
+def pick_transfer(dest, source, do_insert_select, do_copy=None):
+    if do_copy is not None and same_schema(dest, source):
+        return do_copy
+    return do_insert_select
+
+
+def make_make_insert_data(do_insert_select, do_copy=None, do_insert_days=None, batch_days=31):
     '''
     create a factory method
     inject the factory method so functions can make_ dynamically
+
+    a copy job per partition when the schemas are the same
+    INSERT-SELECT when columns are excluded
+    the jobs of all partitions run at the same time,
+    the job manager bounds how many are running
+
+    a destination partitioned on its time column gets batches of batch_days
+    partitions with do_insert_days, one job per batch instead of per day
     '''
+    def insert_batches(dest, source):
+        batches = batch_partitions(source.list_partitions(), batch_days)
+        log_info("{count} batches from {source} to {dest}".format(
+                    count=len(batches), source=source.name, dest=dest.name))
+        wait_all(do_insert_days(dest, source, batches))
+
     def make_insert_data(source):
         def insert_partition_data(dest, source):
-            for partition in source.list_partitions():
-                source.select_id = ''.join([source.table_id, "$", partition])
-                dest.insert_id = ''.join([dest.name, "$", partition])
-                do_insert_select(dest, source)
+            if do_insert_days is not None and is_column_partitioned(dest):
+                return insert_batches(dest, source)
+            transfer = pick_transfer(dest, source, do_insert_select, do_copy)
+            partitions = source.list_partitions()
+            log_info("{count} partitions from {source} to {dest}".format(
+                        count=len(partitions), source=source.name, dest=dest.name))
+            wait_all([transfer(dest, source, partition) for partition in partitions])
 
         def insert_data(dest, source):
-            source.select_id = source.table_id
-            dest.insert_id = dest.name
-            do_insert_select(dest, source)
+            transfer = pick_transfer(dest, source, do_insert_select, do_copy)
+            transfer(dest, source).result()
 
         if is_partitioned(source):
             return insert_partition_data
@@ -123,28 +548,312 @@ def make_load(make_insert):
     return load
 
 
-def make_copy_table(dataset, exclude_columns, rename):
+def _is_rate_limit(error):
+    return getattr(error, 'code', None) == 429 or 'rateLimitExceeded' in str(error)
+
+
+def with_retry(f, retries=5, first_wait=1.0):
+    '''
+    call f again after a rate-limit error
+    wait twice as long after every error
+    '''
+    def retry(*args):
+        wait = first_wait
+        for attempt in range(retries):
+            try:
+                return f(*args)
+            except Exception as error:
+                if not _is_rate_limit(error) or attempt == retries - 1:
+                    raise
+                log_info("rate limit, retry in {wait:.0f}s".format(wait=wait))
+                time.sleep(wait)
+                wait *= 2
+    return retry
+
+
+def parallel_map(f, items, concurrency=8):
+    '''
+    results are in the order of items
+    '''
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(processes=concurrency)
+    results = pool.map(f, items)
+    pool.close()
+    pool.join()
+    return results
+
+
+def make_copy_table(dataset, exclude_columns, rename, time_column=None, cluster_columns=()):
+    '''
+    the copy has DAY partitions on the ingestion time
+    or with a time_column, DAY partitions on it and clustered on cluster_columns,
+    a table without the time column keeps the partitions on the ingestion time
+    '''
+    def create_on_column(t):
+        # this version of the client has no setters for the partition field and clustering
+        resource = t._build_resource()
+        resource['timePartitioning'] = {'type': 'DAY', 'field': time_column}
+        if cluster_columns:
+            resource['clustering'] = {'fields': list(cluster_columns)}
+        path = '/projects/{project}/datasets/{dataset}/tables'.format(
+                    project=dataset.project, dataset=dataset.name)
+        t._set_properties(dataset._client._connection.api_request(
+                            method='POST', path=path, data=resource))
+
     def copy_table(original):
         schema = [col for col in original.schema
                   if col.name not in exclude_columns]
         t = dataset.table(rename(original.name), schema)
         t.partitioning_type = 'DAY'
-        t.create()
+        if has_column(schema, time_column):
+            create_on_column(t)
+        else:
+            t.create()
         return t
     return copy_table
 
 
-def make_copy(f_copy):
+def make_copy(f_copy, concurrency=8):
+    '''
+    the copies are in the order of the tables, so load can zip them
+    '''
+    copy_table = with_retry(f_copy)
+
     def copy(tables):
-        return [f_copy(table) for table in tables]
+        return parallel_map(copy_table, tables, concurrency)
     return copy
 
 
-def make_list_tables(dataset, apply_filter):
+def make_list_tables(dataset, apply_filter, concurrency=8):
+    def reload(table):
+        table.reload()
+        return table
+    reload_table = with_retry(reload)
+
     def list_tables():
         tables = list(dataset.list_tables())
-        for table in tables:
-            table.reload()
+        tables = parallel_map(reload_table, tables, concurrency)
         return apply_filter(tables)
     return list_tables
 
+
+def _order_steps(steps):
+    '''
+    the steps in an order where every step comes after the steps it needs
+    '''
+    ordered = []
+    done = set()
+    waiting = list(steps)
+    while waiting:
+        ready = [step for step in waiting if set(step[2]) <= done]
+        if not ready:
+            raise ValueError("steps need each other: {names}".format(
+                                names=[name for name, _, _ in waiting]))
+        for step in ready:
+            ordered.append(step)
+            done.add(step[0])
+            waiting.remove(step)
+    return ordered
+
+
+def make_run_steps(steps, state_file, concurrency=4):
+    '''
+    steps are (name, step(table_name), names of the steps needed before)
+    the tables run in parallel, the steps of a table one after the other
+
+    a line (table, step) is appended to the state file when a step is done
+    a rerun skips the done steps of the tables it is given
+    unfinished tables of an earlier run which are not given are only logged
+    a failed step stops the steps which need it, the other tables go on
+    '''
+    import csv
+    import os
+    ordered = _order_steps(steps)
+    lock = threading.Lock()
+
+    def load_state():
+        done = collections.defaultdict(set)
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                for table_name, step_name in csv.reader(f):
+                    done[table_name].add(step_name)
+        return done
+
+    def mark_done(table_name, step_name):
+        with lock:
+            with open(state_file, 'a') as f:
+                csv.writer(f).writerow([table_name, step_name])
+
+    def run_table(table_name, done):
+        failed = set()
+        for step_name, step, needs in ordered:
+            if step_name in done:
+                continue
+            if set(needs) & failed:
+                failed.add(step_name)
+                continue
+            log_info("{step} {table}".format(step=step_name, table=table_name))
+            try:
+                step(table_name)
+            except Exception as error:
+                log_info("{step} {table} failed: {error}".format(
+                            step=step_name, table=table_name, error=error))
+                failed.add(step_name)
+                continue
+            done.add(step_name)
+            mark_done(table_name, step_name)
+        return table_name, sorted(failed)
+
+    def run_steps(table_names):
+        state = load_state()
+        all_steps = set(name for name, _, _ in ordered)
+        unfinished = [table_name for table_name, done in state.items()
+                      if done != all_steps and table_name not in table_names]
+        for table_name in sorted(unfinished):
+            log_info("{table} is unfinished from an earlier run, not done: {steps}".format(
+                        table=table_name, steps=','.join(sorted(all_steps - state[table_name]))))
+        results = parallel_map(lambda table_name: run_table(table_name, state[table_name]),
+                               table_names, concurrency)
+        return [(table_name, failed) for table_name, failed in results if failed]
+    return run_steps
+
+
+def make_copy_steps(source_dataset, dest_dataset, copy_table, rename, make_replace_data):
+    '''
+    steps for make_run_steps, each can run again after a crash
+        create the destination table
+        |> load all partitions
+        |> verify the row counts, with the streaming buffer
+
+    make_replace_data writes with WRITE_TRUNCATE, a load which stopped midway
+    replaces the partitions it already wrote instead of appending to them
+    '''
+    def get_table(dataset, table_name):
+        table = dataset.table(table_name)
+        table.reload()
+        return table
+
+    def create(table_name):
+        if not dest_dataset.table(rename(table_name)).exists():
+            copy_table(get_table(source_dataset, table_name))
+
+    def load(table_name):
+        source = get_table(source_dataset, table_name)
+        dest = get_table(dest_dataset, rename(table_name))
+        replace_data = make_replace_data(source)
+        replace_data(dest, source)
+
+    def verify(table_name):
+        source_rows = count_rows(source_dataset, table_name)
+        dest_rows = count_rows(dest_dataset, rename(table_name))
+        if source_rows != dest_rows:
+            raise RuntimeError("{source} has {source_rows} rows, {dest} has {dest_rows}".format(
+                                source=table_name, source_rows=source_rows,
+                                dest=rename(table_name), dest_rows=dest_rows))
+
+    return [('create', create, []),
+            ('load', load, ['create']),
+            ('verify', verify, ['load'])]
+
+
+def run_query(client, sql, legacy=True):
+    query_job = client.run_async_query(_job_id(), sql)
+    query_job.use_legacy_sql = legacy
+    query_job.begin()
+    query_job.result()
+    destination_table = query_job.destination
+    destination_table.reload()
+    return destination_table.fetch_data()
+
+
+def count_rows(dataset, table_name):
+    '''
+    num_rows of the table metadata leaves out the streaming buffer, COUNT(*) does not
+    '''
+    sql = """
+    SELECT COUNT(*) FROM `{project}.{dataset}.{table}`
+    """.format(project=dataset.project, dataset=dataset.name, table=table_name)
+    for row in run_query(dataset._client, sql, legacy=False):
+        return row[0]
+
+
+def _partition_summary_sql(project, dataset_name):
+    return """
+    SELECT
+        table_name,
+        partition_id,
+        last_modified_time,
+        total_rows
+    FROM `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+    WHERE partition_id IS NULL
+       OR partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+    """.format(project=project, dataset=dataset_name)
+
+
+def make_read_partition_summary(client, project, dataset_name):
+    '''
+    one query for all partitions of all tables in the dataset
+    read_partition_summary() |> {(table_name, partition_id): (last_modified, rows)}
+    the partition_id of a table without partitions is None
+    '''
+    def read_partition_summary():
+        rows = run_query(client, _partition_summary_sql(project, dataset_name), legacy=False)
+        return {(table_name, partition_id): (last_modified, total_rows)
+                for table_name, partition_id, last_modified, total_rows in rows}
+    return read_partition_summary
+
+
+def plan_sync(source_summary, dest_summary, rename):
+    '''
+    the partitions missing in the destination,
+    modified at the source after the destination or with other row counts
+    |> {table_name: [partition_id, ..]}
+    '''
+    plan = collections.defaultdict(list)
+    for (table_name, partition), (modified, rows) in source_summary.items():
+        dest = dest_summary.get((rename(table_name), partition))
+        if dest is None or modified > dest[0] or rows != dest[1]:
+            plan[table_name].append(partition)
+    return {table_name: sorted(partitions) for table_name, partitions in plan.items()}
+
+
+def make_sync(read_source_summary, read_dest_summary, dest_dataset, copy_table, rename,
+              replace_select, replace_partition, time_column=None):
+    '''
+    copy only what changed since the last sync
+        read the partition summaries of both datasets
+        |> plan_sync
+        |> replace the planned partitions, all jobs at the same time
+
+    a missing destination table is created first
+    a partition is replaced with WRITE_TRUNCATE, never appended to
+    tables partitioned on time_column are skipped, before they are created
+    '''
+    def sync(tables):
+        source_tables = {table.name: table for table in tables}
+        plan = plan_sync(read_source_summary(), read_dest_summary(), rename)
+        plan = {table_name: partitions for table_name, partitions in plan.items()
+                if table_name in source_tables}
+        log_info("{partitions} partitions of {tables} tables to sync".format(
+                    partitions=sum(len(p) for p in plan.values()), tables=len(plan)))
+
+        futures = []
+        for table_name, partitions in sorted(plan.items()):
+            source = source_tables[table_name]
+            dest = dest_dataset.table(rename(table_name))
+            exists = dest.exists()
+            if exists:
+                dest.reload()
+            if is_column_partitioned(dest) if exists else has_column(source.schema, time_column):
+                log_info("skip {dest}, sync needs partitions on the ingestion time".format(
+                            dest=dest.name))
+                continue
+            if not exists:
+                dest = copy_table(source)
+            transfer = pick_transfer(dest, source, replace_select, replace_partition)
+            log_info("sync {count} partitions from {source} to {dest}".format(
+                        count=len(partitions), source=source.name, dest=dest.name))
+            futures.extend(transfer(dest, source, partition) for partition in partitions)
+        wait_all(futures)
+        return plan
+    return sync
@@ -0,0 +1,420 @@
+'''
+Checksum the content of every hour of every day of a table.
+
+a row is normalized to a string
+    every column is cast to a string in the same format on Redshift and BigQuery
+    NULL is <null>, columns are separated by |
+the first 16 hex digits of MD5(row) are split into 2 numbers of 32 bit
+the checksum of an hour is the sum of these numbers over its rows
+
+sums do not depend on the order of the rows
+and roll up from hour to day to table
+
+    hour |> day |> table
+
+one scan per table and database
+the diff walks the tree from the table down to the hour
+'''
+
+from google.cloud import bigquery
+from multiprocessing.pool import ThreadPool
+import pandas as pd
+
+from config import config, load_config
+from lib import make_gen_csv, log_info, pp
+import bq_lib as bq
+import rs
+
+
+_checksum_columns = ['row_count', 'checksum_a', 'checksum_b']
+
+
+#
+# --> RedShift
+#
+def rs_configure(options):
+    project = options['PROJECT']
+    settings = config[project]['rs']
+    schema = settings['schema']
+    time_column = 'timestamp'
+
+    aws_json = '../../etc/{proj}/aws.json'.format(proj=project)
+    aws_config = load_config(aws_json)
+    engine = rs.connect(project, aws_config)
+
+    rs_query = rs.make_run(engine, schema)
+    column_types = {(table_name, column_name): column_type
+                    for table_name, column_name, column_type
+                    in rs_query(_rs_read_column_type_sql(schema))}
+
+    row_checksum_sql = rs_make_row_checksum_sql(column_types)
+    checksum_sql = rs_make_checksum_hourly_sql(time_column, row_checksum_sql)
+    read_checksum = rs_make_read_checksum(rs_query, checksum_sql)
+
+    inject = {'csv_checksum': "rs_{project}_checksum_hourly.csv".format(project=project),
+              'read_checksum': read_checksum}
+    return inject
+
+
+def _rs_read_column_type_sql(schema):
+    return """
+    SELECT table_name, column_name, data_type
+    FROM information_schema.columns
+    WHERE table_schema = '{table_schema}'
+    """.format(table_schema=schema)
+
+
+def _normalize_sql_for(normalizers, column, column_type, db):
+    if column_type not in normalizers:
+        raise ValueError("{db} column {column} has type {column_type}, no checksum for it".format(
+                            db=db, column=column, column_type=column_type))
+    return normalizers[column_type]
+
+
+# a float is printed the same way on both databases
+#   NaN and the infinities as tokens, -0.0 and what rounds to 0 as 0
+#   from 1e15 on as a mantissa with 9 decimals and an exponent, DECIMAL(38,6) overflows
+#   else rounded half away from zero to 6 decimals, printed with exactly 6 decimals
+_float_tokens = [('nan', "'<nan>'"),
+                 ('inf', "'<inf>'"),
+                 ('-inf', "'<-inf>'"),
+                 ('zero', "'0.000000'")]
+_float_large = '1e15'
+
+
+def _float_normalize_sql(is_case, large_sql, fixed_sql):
+    # concatenated, the {c} in the parts is filled in later
+    whens = ['WHEN ' + is_case[case] + ' THEN ' + token for case, token in _float_tokens]
+    whens.append('WHEN ABS({c}) >= ' + _float_large + ' THEN ' + large_sql)
+    return 'CASE ' + ' '.join(whens) + ' ELSE ' + fixed_sql + ' END'
+
+
+_rs_float = _float_normalize_sql(
+    {'nan': "{c} = 'NaN'::float",
+     'inf': "{c} = 'Infinity'::float",
+     '-inf': "{c} = '-Infinity'::float",
+     'zero': "ROUND({c}, 6) = 0"},
+    "CAST(CAST(ROUND({c} / POWER(10, FLOOR(LOG(ABS({c})))), 9) AS DECIMAL(38,9)) AS VARCHAR)"
+    " || 'e' || CAST(CAST(FLOOR(LOG(ABS({c}))) AS BIGINT) AS VARCHAR)",
+    "CAST(CAST(ROUND({c}, 6) AS DECIMAL(38,6)) AS VARCHAR)")
+
+_rs_normalize = {
+    'bigint': "CAST({c} AS VARCHAR)",
+    'smallint': "CAST({c} AS VARCHAR)",
+    'integer': "CAST({c} AS VARCHAR)",
+    'real': _rs_float,
+    'double precision': _rs_float,
+    'numeric': _rs_float,
+    'character': "RTRIM({c})",
+    'character varying': "RTRIM({c})",
+    'boolean': "CASE WHEN {c} THEN '1' WHEN NOT {c} THEN '0' END",
+    'timestamp with time zone': "CAST(CAST(FLOOR(EXTRACT(epoch FROM {c})) AS BIGINT) AS VARCHAR)",
+    'timestamp without time zone': "CAST(CAST(FLOOR(EXTRACT(epoch FROM {c})) AS BIGINT) AS VARCHAR)",
+    'date': "TO_CHAR({c}, 'YYYY-MM-DD')",
+    }
+
+
+def rs_normalize_column_sql(column, column_type):
+    normalize = _normalize_sql_for(_rs_normalize, column, column_type, 'rs')
+    return "COALESCE({value}, '<null>')".format(value=normalize.format(c='"{}"'.format(column)))
+
+
+def rs_make_row_checksum_sql(column_types):
+    def row_checksum_sql(table, columns):
+        values = " || '|' || ".join([rs_normalize_column_sql(c, column_types[(table, c)])
+                                     for c in columns])
+        return "MD5({values})".format(values=values)
+    return row_checksum_sql
+
+
+def rs_make_checksum_hourly_sql(time_column, row_checksum_sql):
+    def checksum_hourly_sql(table, columns, start_day, end_day):
+        return """
+        WITH
+        derived_hash AS (
+            SELECT
+                to_char("{timestamp}", 'YYYYMMDD') AS event_day,
+                extract(hour from "{timestamp}") AS event_hour,
+                {row_hash} AS row_hash
+            FROM {table}
+            WHERE date("{timestamp}") BETWEEN '{start_day}' AND '{end_day}'
+            )
+
+        SELECT
+            event_day,
+            event_hour,
+            count(*) AS row_count,
+            sum(STRTOL(SUBSTRING(row_hash, 1, 8), 16)) AS checksum_a,
+            sum(STRTOL(SUBSTRING(row_hash, 9, 8), 16)) AS checksum_b
+        FROM derived_hash
+        GROUP BY event_day, event_hour
+        """.format(table=table, timestamp=time_column,
+                   row_hash=row_checksum_sql(table, columns),
+                   start_day=start_day, end_day=end_day)
+    return checksum_hourly_sql
+
+
+def rs_make_read_checksum(rs_query, checksum_hourly_sql):
+    def read_checksum(table, columns, start_day, end_day):
+        return rs_query(checksum_hourly_sql(table, columns, start_day, end_day))
+    return read_checksum
+
+
+#
+# --> BigQuery
+#
+def bq_configure(options):
+    project = options['PROJECT']
+    settings = config[project]['bq']
+    time_column = 'timestamp'
+    extend_search = 1
+
+    gcp_cfg = '../../etc/{proj}/gcp.json'.format(proj=project)
+    gc_client = bigquery.Client.from_service_account_json(gcp_cfg)
+    dataset = gc_client.dataset(settings['dataset'])
+
+    list_tables = bq.make_list_tables(dataset, lambda x: x)
+    column_types = {(table.name, field.name): field.field_type
+                    for table in list_tables()
+                    for field in table.schema}
+
+    row_checksum_sql = bq_make_row_checksum_sql(column_types)
+    checksum_sql = bq_make_checksum_hourly_sql(time_column, extend_search, row_checksum_sql)
+    read_checksum = bq_make_read_checksum(settings['project'],
+                                          settings['dataset'],
+                                          gcp_cfg,
+                                          checksum_sql)
+
+    inject = {'csv_checksum': "bq_{project}_checksum_hourly.csv".format(project=project),
+              'read_checksum': read_checksum}
+    return inject
+
+
+_bq_float = _float_normalize_sql(
+    {'nan': "IS_NAN({c})",
+     'inf': "IS_INF({c}) AND {c} > 0",
+     '-inf': "IS_INF({c}) AND {c} < 0",
+     'zero': "ROUND({c}, 6) = 0"},
+    "CONCAT(FORMAT('%.9f', ROUND({c} / POW(10, FLOOR(LOG10(ABS({c})))), 9)),"
+    " 'e', CAST(CAST(FLOOR(LOG10(ABS({c}))) AS INT64) AS STRING))",
+    "FORMAT('%.6f', ROUND({c}, 6))")
+
+# RTRIM strips only spaces, the same as on Redshift
+_bq_normalize = {
+    'INTEGER': "CAST({c} AS STRING)",
+    'FLOAT': _bq_float,
+    'NUMERIC': _bq_float,
+    'STRING': "RTRIM({c}, ' ')",
+    'BOOLEAN': "CASE WHEN {c} THEN '1' WHEN NOT {c} THEN '0' END",
+    'TIMESTAMP': "CAST(UNIX_SECONDS({c}) AS STRING)",
+    'DATETIME': "CAST(UNIX_SECONDS(TIMESTAMP({c})) AS STRING)",
+    'DATE': "FORMAT_DATE('%Y-%m-%d', {c})",
+    }
+
+
+def bq_normalize_column_sql(column, column_type):
+    normalize = _normalize_sql_for(_bq_normalize, column, column_type, 'bq')
+    return "COALESCE({value}, '<null>')".format(value=normalize.format(c='`{}`'.format(column)))
+
+
+def bq_make_row_checksum_sql(column_types):
+    def row_checksum_sql(table, columns):
+        values = ", '|', ".join([bq_normalize_column_sql(c, column_types[(table, c)])
+                                 for c in columns])
+        return "TO_HEX(MD5(CONCAT({values})))".format(values=values)
+    return row_checksum_sql
+
+
+def bq_make_checksum_hourly_sql(time_column, extend_search, row_checksum_sql):
+    def checksum_hourly_sql(table, dataset_name, columns, start_day, end_day):
+        return """
+        WITH
+        derived_hash AS (
+            SELECT
+                format_date('%Y%m%d', DATE({timestamp})) AS event_day,
+                extract(hour from {timestamp}) AS event_hour,
+                {row_hash} AS row_hash
+            FROM {dataset}.{table}
+            WHERE _PARTITIONTIME
+                BETWEEN TIMESTAMP(datetime_sub(DATETIME('{start_day}'), interval {extend_days} day))
+                AND TIMESTAMP(datetime_add(DATETIME('{end_day}'), interval {extend_days} day))
+            AND DATE({timestamp}) BETWEEN '{start_day}'
+                                      AND '{end_day}'
+            )
+
+        SELECT
+            event_day,
+            event_hour,
+            count(*) AS row_count,
+            sum(CAST(CONCAT('0x', SUBSTR(row_hash, 1, 8)) AS INT64)) AS checksum_a,
+            sum(CAST(CONCAT('0x', SUBSTR(row_hash, 9, 8)) AS INT64)) AS checksum_b
+        FROM derived_hash
+        GROUP BY event_day, event_hour
+        """.format(table=table, dataset=dataset_name, timestamp=time_column,
+                   row_hash=row_checksum_sql(table, columns),
+                   start_day=start_day, end_day=end_day,
+                   extend_days=extend_search)
+    return checksum_hourly_sql
+
+
+def bq_make_read_checksum(project, dataset_name, gcp_key, checksum_hourly_sql):
+    def read_checksum(table_name, columns, start_day, end_day):
+        df = pd.read_gbq(
+                    checksum_hourly_sql(table_name, dataset_name, columns, start_day, end_day),
+                    dialect = 'standard',
+                    project_id = project,
+                    private_key = gcp_key)
+        return df.itertuples(index=False)
+    return read_checksum
+
+
+#
+# FUNCTIONALITY
+#
+def group_columns(gen_columns):
+    '''
+    tablename,column,min_day,max_day rows
+    to tablename -> (sorted columns, min_day, max_day)
+    '''
+    tables = {}
+    for table, column, start_day, end_day in gen_columns:
+        columns, _, _ = tables.get(table, ([], start_day, end_day))
+        tables[table] = (columns + [column], start_day, end_day)
+    return {table: (sorted(columns), start_day, end_day)
+            for table, (columns, start_day, end_day) in tables.items()}
+
+
+def make_checksum_table(read_checksum):
+    def checksum_table(table_info):
+        table, (columns, start_day, end_day) = table_info
+        log_info("checksum {count} columns of {table}".format(count=len(columns), table=table))
+        return [{'tablename': table, 'on_day': int(r[0]), 'on_hour': int(r[1]),
+                 'row_count': int(r[2]), 'checksum_a': int(r[3]), 'checksum_b': int(r[4])}
+                for r in read_checksum(table, columns, start_day, end_day)]
+    return checksum_table
+
+
+def checksum_tables(tables, checksum_table, csv_out):
+    '''
+    tables
+    |> checksum_table
+    |> flatten
+    |> to_csv
+    '''
+    pool = ThreadPool(processes=8)
+    results = pool.map(checksum_table, sorted(tables.items()))
+    pool.close()
+    pool.join()
+
+    df = pd.DataFrame([item for result in results for item in result])
+    df = df.sort_values(['tablename', 'on_day', 'on_hour'])
+    df.to_csv(csv_out, header=False, index=False,
+              columns=['tablename', 'on_day', 'on_hour'] + _checksum_columns)
+
+
+def _load_checksum(csv_checksum):
+    return pd.read_csv(csv_checksum, header=None,
+                       names=['tablename', 'on_day', 'on_hour'] + _checksum_columns)
+
+
+def checksum_tree(df):
+    '''
+    roll up hour |> day |> table
+    '''
+    hours = df.set_index(['tablename', 'on_day', 'on_hour'])[_checksum_columns]
+    days = hours.groupby(level=[0, 1]).sum()
+    tables = days.groupby(level=0).sum()
+    return [tables, days, hours]
+
+
+def _differ(level_rs, level_bq):
+    df = level_rs.join(level_bq, how='outer', lsuffix='_rs', rsuffix='_bq').fillna(0)
+    is_diff = False
+    for column in _checksum_columns:
+        is_diff = is_diff | (df[column + '_rs'] != df[column + '_bq'])
+    return df[is_diff]
+
+
+def diff_tree(tree_rs, tree_bq):
+    '''
+    compare a level only below the differing nodes of the level above
+    '''
+    diffs = []
+    keys = None
+    for level_rs, level_bq in zip(tree_rs, tree_bq):
+        if keys is not None:
+            level_rs = level_rs[level_rs.index.droplevel(-1).isin(keys)]
+            level_bq = level_bq[level_bq.index.droplevel(-1).isin(keys)]
+        df = _differ(level_rs, level_bq)
+        diffs.append(df)
+        if df.empty:
+            break
+        keys = df.index
+    return diffs
+
+
+def verify(csv_rs, csv_bq, csv_out):
+    tree_rs = checksum_tree(_load_checksum(csv_rs))
+    tree_bq = checksum_tree(_load_checksum(csv_bq))
+    diffs = diff_tree(tree_rs, tree_bq)
+
+    for name, df in zip(['tables', 'days', 'hours'], diffs):
+        log_info("{count} {name} differ".format(count=len(df), name=name))
+    pp(diffs[0])
+
+    hours = diffs[-1]
+    if len(diffs) == 3 and not hours.empty:
+        hours.to_csv(csv_out, header=False, index=True)
+
+
+def main(options):
+    project = options['PROJECT']
+
+    if options['--diff']:
+        csv_rs = "rs_{project}_checksum_hourly.csv".format(project=project)
+        csv_bq = "bq_{project}_checksum_hourly.csv".format(project=project)
+        csv_out = "checksum_diff_{project}.csv".format(project=project)
+        verify(csv_rs, csv_bq, csv_out)
+        return
+
+    if options['--rs']:
+        inject = rs_configure(options)
+    elif options['--bq']:
+        inject = bq_configure(options)
+
+    if options['--in']:
+        csv_columns = options['--in']
+    else:
+        csv_columns = "rs_{project}_columns_minmax_day.csv".format(project=project)
+
+    tables = group_columns(make_gen_csv(csv_columns))
+    checksum_table = make_checksum_table(inject['read_checksum'])
+    checksum_tables(tables, checksum_table, inject['csv_checksum'])
+
+
+_usage="""
+Checksum the rows per table, day and hour
+Create csv with tablename,on_day,on_hour,row_count,checksum_a,checksum_b
+
+Usage:
+  db_checksum (--rs | --bq) [--in=<i>] PROJECT
+  db_checksum --diff PROJECT
+
+Arguments:
+  PROJECT    name of the project
+
+Options:
+  -h --help   show this
+  --rs        use Redshift
+  --bq        use Bigquery
+  --in=<i>    read tablename,column,min_day,max_day from this file
+              the same file must be used for --rs and --bq
+  --diff      compare the rs and bq checksums
+"""
+
+from docopt import docopt
+
+
+if __name__ == '__main__':
+    options = docopt(_usage)
+    main(options)
@@ -5,6 +5,7 @@ Outputs the results to a CSV file.
 '''
 
 from google.cloud import bigquery
+import csv
 import uuid
 import pandas as pd
 
@@ -26,7 +27,7 @@ def rs_configure(options):
 
     aws_json = '../../etc/{proj}/aws.json'.format(proj=project)
     aws_config = load_config(aws_json)
-    engine = rs.connect(settings['game_title'], aws_config)
+    engine = rs.connect(settings['title'], aws_config)
 
     if options['--in']:
         csv_tables = options['--in']
@@ -98,13 +99,24 @@ def bq_configure_daily(options):
         csv_count = "bq_{project}_table_daily_rows.csv".format(project=project)
 
 
-    count_rows = bq_make_count_rows_daily(time_column)
-    read_count = bq_make_count_daily(gc_client, schema, count_rows)
+    cost_guard = bq.make_budget_guard(gc_client, options.get('--budget'))
+    csv_cost = "bq_{project}_count_daily_cost.csv".format(project=project)
+
+    # rows loaded or streamed a day before or after their day
+    slack_days = int(options.get('--slack') or 1)
+    unpruned = options.get('--unpruned', False)
+    partition_filter_sql = bq.make_partition_filter_sql(slack_days, unpruned)
+
+    count_rows = bq_make_count_rows_daily(time_column, partition_filter_sql)
+    read_count = bq_make_count_daily(gc_client, schema, count_rows,
+                                     bq.make_check_pruned(unpruned), cost_guard)
     gen_tables = make_gen_csv(csv_tables)
 
     inject = {'csv_count': csv_count,
               'gen_tables': gen_tables,
               'read_count': read_count,
+              'cost_guard': cost_guard,
+              'csv_cost': csv_cost,
               'ignore': settings['ignore_table'],
              }
     return inject
@@ -123,12 +135,17 @@ def bq_configure_whole(options):
     csv_tables = "bq_{project}_minmax_day.csv".format(project=project)
     csv_count = "bq_{project}_table_rows.csv".format(project=project)
 
-    read_count = bq_make_whole_count(gc_client, schema)
+    cost_guard = bq.make_budget_guard(gc_client, options.get('--budget'))
+    csv_cost = "bq_{project}_count_whole_cost.csv".format(project=project)
+
+    read_count = bq_make_whole_count(gc_client, schema, cost_guard)
     gen_tables = make_gen_csv(csv_tables)
 
     inject = {'csv_count': csv_count,
               'gen_tables': gen_tables,
               'read_count': read_count,
+              'cost_guard': cost_guard,
+              'csv_cost': csv_cost,
               'ignore': settings['ignore_table'],
              }
     return inject
@@ -143,8 +160,10 @@ def bq_configure(options):
         return bq_configure_daily(options)
 
 
-def bq_run_query(client, sql):
+def bq_run_query(client, sql, cost_guard=None, stage=None, table=None):
     query_job = client.run_async_query(str(uuid.uuid4()), sql)
+    if cost_guard is not None:
+        query_job.maximum_bytes_billed = cost_guard['check'](sql, stage, table, legacy=True)
     query_job.begin()
     query_job.result()
 
@@ -154,7 +173,7 @@ def bq_run_query(client, sql):
         yield row
 
 
-def bq_make_count_rows_daily(time_column):
+def bq_make_count_rows_daily(time_column, partition_filter_sql):
     def count_rows_daily(table, start_day, end_day):
         return """
         SELECT
@@ -165,20 +184,24 @@ def bq_make_count_rows_daily(time_column):
         WHERE
           DATE({timestamp}) BETWEEN '{start_day}'
                                 AND '{end_day}'
+          {partition}
         GROUP BY
           day_part
         ORDER BY
           day_part
         """.format(table_id=table,
                 timestamp=time_column,
-                start_day=start_day, end_day=end_day)
+                start_day=start_day, end_day=end_day,
+                partition=partition_filter_sql(start_day, end_day))
     return count_rows_daily
 
 
-def bq_make_count_daily(client, table_pre, count_rows_daily):
+def bq_make_count_daily(client, table_pre, count_rows_daily, check_pruned, cost_guard=None):
     def count_daily(table_id, start_day, end_day):
         table = '.'.join([table_pre, table_id])
-        return bq_run_query(client, count_rows_daily(table, start_day, end_day))
+        sql = count_rows_daily(table, start_day, end_day)
+        check_pruned(sql, table_id)
+        return bq_run_query(client, sql, cost_guard, 'count_daily', table_id)
     return count_daily
 
 
@@ -191,10 +214,11 @@ def _bq_count_whole_rows(table, column):
     """.format(table_id=table, count_column=column)
 
 
-def bq_make_whole_count(client, table_prefix):
+def bq_make_whole_count(client, table_prefix, cost_guard=None):
     def count_whole(table_name, column):
         table = '.'.join([table_prefix, table_name])
-        return bq_run_query(client, _bq_count_whole_rows(table, column))
+        return bq_run_query(client, _bq_count_whole_rows(table, column),
+                            cost_guard, 'count_whole', table_name)
     return count_whole
 
 
@@ -273,6 +297,45 @@ def count_rows_daily(tables, read_daily_count, csv_out):
               columns=['tablename', 'on_day', 'total_rows'])
 
 
+def count_rows_daily_stream(tables, read_daily_count, csv_out, window=8):
+    '''
+    tables
+    |> read_daily_count
+    |> reorder
+    |> append_to_csv
+
+    the rows of a table are written as soon as the table
+    and all the tables before it are counted
+    at most _window_ tables are in flight or waiting to be written
+    '''
+    from collections import deque
+    from multiprocessing.pool import ThreadPool
+
+    def read_all(table):
+        return [r for r in read_daily_count(table)]
+
+    pool = ThreadPool(processes=window)
+    pending = deque()
+
+    with open(csv_out, 'w', newline='') as f:
+        writer = csv.writer(f)
+
+        def write_next():
+            for item in pending.popleft().get():
+                writer.writerow([item['tablename'], item['on_day'], item['total_rows']])
+            f.flush()
+
+        for table in tables:
+            pending.append(pool.apply_async(read_all, (table,)))
+            if len(pending) >= window:
+                write_next()
+        while pending:
+            write_next()
+
+    pool.close()
+    pool.join()
+
+
 def main(options):
     end_day = options['END_DAY']
 
@@ -290,7 +353,10 @@ def main(options):
         csv_count = inject['csv_count']
         f_db_daily = inject['read_count']
         f_count = make_count_daily(f_db_daily)
-        count_rows = count_rows_daily
+        if options['--stream']:
+            count_rows = count_rows_daily_stream
+        else:
+            count_rows = count_rows_daily
 
     if options['--whole']:
         gen_tables = inject['gen_tables']
@@ -301,6 +367,9 @@ def main(options):
 
     count_rows(gen_tables, f_count, csv_count)
 
+    if inject.get('cost_guard'):
+        bq.write_cost_report(inject['cost_guard'], inject['csv_cost'])
+
 
 # Options probably must start with a unique letter
 # --rsload and --rsunload does not work
@@ -309,21 +378,26 @@ Perform row count
 Create csv with tablename,on_day,row_count
 
 Usage:
-  db_count (--rs | --bq) (--daily [--column=<c>] | --whole) [--in=<i>] [--out=<o>] PROJECT END_DAY
+  db_count (--rs | --bq) (--daily [--column=<c>] [--stream] [--slack=<d>] [--unpruned] | --whole) [--in=<i>] [--out=<o>] [--budget=<gb>] PROJECT END_DAY
 
 Arguments:
   PROJECT    name of the project
   END_DAY    upper bound in YYYYMMDD for row count
 
 Options:
-  -h --help     show this
-  --rs          use Redshift
-  --bq          use Bigquery
-  --daily       only tables with time-column (events, facts)
-  --column=<c>  name of time-column
-  --whole       only tables with no time-column (dimensions)
-  --in=<i>      read tables from this file
-  --out=<o>     write row counts to this file
+  -h --help      show this
+  --rs           use Redshift
+  --bq           use Bigquery
+  --daily        only tables with time-column (events, facts)
+  --column=<c>   name of time-column
+  --stream       write the rows of each table as soon as it is counted
+  --slack=<d>    rows are at most d days from the partition of their day [default: 1]
+  --unpruned     allow queries without _PARTITIONTIME filter, for tables without partitions
+  --whole        only tables with no time-column (dimensions)
+  --in=<i>       read tables from this file
+  --out=<o>      write row counts to this file
+  --budget=<gb>  dry run the BigQuery queries, stop before the run scans more GB
+                 and write the bytes per table to a cost csv
 """
 
 from docopt import docopt
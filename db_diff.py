@@ -31,8 +31,10 @@ def bq_configure(options):
 
     csv_count = "bq_{project}_table_rows.csv".format(project=project)
     csv_count = "bq_{project}_table_daily_rows.csv".format(project=project)
+    csv_partition = "bq_{project}_table_partitions.csv".format(project=project)
 
-    inject = {'csv_count': csv_count}
+    inject = {'csv_count': csv_count,
+              'csv_partition': csv_partition}
     return inject
 
 
@@ -80,39 +82,65 @@ def make_print_csv_all(csv_out):
     return print_csv_all
 
 
-def _load_bq_partition(csv_partition, ignore):
-    df = pd.read_csv(csv_partition, header=None,
-                     names=['tablename', 'on_day'])
-    df = df.set_index(['tablename', 'on_day'])
-    df['is_part'] = 1
+def _read_table(file_name, names):
+    '''
+    csv without header or parquet with the named columns
+    '''
+    if file_name.endswith('.parquet'):
+        df = pd.read_parquet(file_name, columns=names)
+    else:
+        df = pd.read_csv(file_name, header=None, names=names)
+    df['tablename'] = df['tablename'].astype('category')
     return df
 
 
-def _load_bq_daily(bq_csv, ignore):
-    df = pd.read_csv(bq_csv, header=None,
-            names=['tablename', 'on_day', 'total_rows'])
-    df = df[~df.tablename.isin(ignore)]
-    df['on_day'] = df['on_day'].str.replace('-', '')
-    df['on_day'] = pd.to_numeric(df['on_day'])
-    df = df.set_index(['tablename', 'on_day'])
+def _day_key(on_day):
+    '''
+    2017-09-30, a date or 20170930 to the integer 20170930
+    '''
+    if pd.api.types.is_integer_dtype(on_day):
+        return on_day.astype(np.int32)
+    if not pd.api.types.is_datetime64_any_dtype(on_day):
+        on_day = pd.to_datetime(on_day.astype(str).str.replace('-', '', regex=False),
+                                format='%Y%m%d')
+    days = on_day.dt
+    return (days.year * 10000 + days.month * 100 + days.day).astype(np.int32)
+
+
+def _load_bq_partition(partition_file, ignore):
+    df = _read_table(partition_file, ['tablename', 'on_day'])
+    df['on_day'] = _day_key(df['on_day'])
+    df['is_part'] = 1
     return df
 
 
-def _load_bq(bq_csv, ignore):
-    df_bq = _load_bq_daily(bq_csv, ignore)
-    df_bq_part = _load_bq_partition('bq_bora_table_partitions.csv', ignore)
-    df_bq = df_bq.join(df_bq_part)
+def _load_daily(count_file, ignore):
+    df = _read_table(count_file, ['tablename', 'on_day', 'total_rows'])
+    df['on_day'] = _day_key(df['on_day'])
+    return df[~df.tablename.isin(ignore)]
+
+
+def _load_bq(bq_file, partition_file, ignore):
+    df_bq = _load_daily(bq_file, ignore)
+    df_bq_part = _load_bq_partition(partition_file, ignore)
+    df_bq = _join(df_bq, df_bq_part)
     return df_bq
 
 
-def _load_rs(rs_csv, ignore):
-    df = pd.read_csv(rs_csv, header=None,
-            names=['tablename', 'on_day', 'total_rows'])
-    df = df[~df.tablename.isin(ignore)]
-    df['on_day'] = df['on_day'].str.replace('-', '')
-    df['on_day'] = pd.to_numeric(df['on_day'])
-    df = df.set_index(['tablename', 'on_day'])
-    return df
+def _load_rs(rs_file, ignore):
+    return _load_daily(rs_file, ignore)
+
+
+def _join(df_left, df_right, suffixes=('_x', '_y')):
+    '''
+    left join on tablename,on_day
+    both tablename columns must share the categories
+    '''
+    tables = df_left.tablename.cat.categories.union(df_right.tablename.cat.categories)
+    df_left = df_left.assign(tablename=df_left.tablename.cat.set_categories(tables))
+    df_right = df_right.assign(tablename=df_right.tablename.cat.set_categories(tables))
+    return df_left.merge(df_right, how='left', on=['tablename', 'on_day'],
+                         suffixes=suffixes)
 
 
 def _calc_diff(df_cmp):
@@ -120,38 +148,40 @@ def _calc_diff(df_cmp):
     df_cmp['relative_diff'] = (df_cmp.absolute_diff *100.0) \
                                / df_cmp.total_rows_rs
 
-    groups = df_cmp.groupby(axis=0, level=0)
-    table_total = groups['total_rows_rs'].aggregate(np.sum)
-    df_cmp['total_table_rs'] = df_cmp.join(table_total,
-                                           rsuffix='_table')['total_rows_rs_table']
-
-    table_total = groups['total_rows_bq'].aggregate(np.sum)
-    df_cmp['total_table_bq'] = df_cmp.join(table_total,
-                                           rsuffix='_table')['total_rows_bq_table']
-
-    table_parts = groups['total_rows_rs'].count()
-    df_cmp['no_days'] = df_cmp.join(table_parts,
-                                     rsuffix='_part')['total_rows_rs_part']
+    groups = df_cmp.groupby(level=0, observed=True, sort=False)
+    table_total = groups[['total_rows_rs', 'total_rows_bq']].transform('sum')
+    df_cmp['total_table_rs'] = table_total['total_rows_rs']
+    df_cmp['total_table_bq'] = table_total['total_rows_bq']
+    df_cmp['no_days'] = groups['total_rows_rs'].transform('count')
 
     df_cmp['relative_table_diff'] = (df_cmp.absolute_diff *100.0) \
                                      / df_cmp.total_table_rs
-    
+
     return df_cmp
 
 
-def verify(rs_csv, bq_csv, validator=validate_summary, printer=pp, ignore=[]):
+def compare(rs_file, bq_file, partition_file, ignore=[]):
     '''
     load_sources
     |> join_sources
     |> calc_diff
+    '''
+    df_rs = _load_rs(rs_file, ignore)
+    df_bq = _load_bq(bq_file, partition_file, ignore)
+
+    df_cmp = _join(df_rs, df_bq, suffixes=('_rs', '_bq'))
+    df_cmp = df_cmp.set_index(['tablename', 'on_day'])
+    return _calc_diff(df_cmp)
+
+
+def verify(rs_file, bq_file, partition_file,
+           validator=validate_summary, printer=pp, ignore=[]):
+    '''
+    compare
     |> filter_diff
     |> print_diff
     '''
-    df_rs = _load_rs(rs_csv, ignore)
-    df_bq = _load_bq(bq_csv, ignore)
-
-    df_cmp = df_rs.join(df_bq, lsuffix='_rs', rsuffix='_bq')
-    df_cmp = _calc_diff(df_cmp)
+    df_cmp = compare(rs_file, bq_file, partition_file, ignore)
 
     if validator == validate_summary:
         pp(validator(df_cmp))
@@ -188,6 +218,7 @@ def main(options):
 
     ignore = ['storm_warn', 'weather_adjust']
     verify(rs_inject['csv_count'], bq_inject['csv_count'],
+           bq_inject['csv_partition'],
            validator, printer, ignore)
 
 
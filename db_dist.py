@@ -12,16 +12,31 @@ hard-coded values like 0.1, 0.000000000001, -1.0 are used for debugging
 '''
 
 from google.cloud import bigquery
+import json
+import os
 import numpy as np
 import pandas as pd
 
 import db_diff as db
+import db_checksum as checksum
 from config import config, load_config
 from lib import make_gen_csv, log_info
 import bq_lib as bq
 import rs
 
 
+# the relative error bound of an approximate distinct count,
+# written to the csv with the count, db_stats_diff adds up the bounds of both sides
+#
+# Redshift APPROXIMATE COUNT(DISTINCT) uses HyperLogLog,
+# the Redshift docs state a relative error of around 2%
+_rs_approx_distinct_error = 0.02
+#
+# BigQuery APPROX_COUNT_DISTINCT uses HyperLogLog++ with precision 15,
+# relative standard error 1.04 / sqrt(2^15) = 0.0057, the bound is 3 standard errors
+_bq_approx_distinct_error = 0.0172
+
+
 #
 # --> RedShift
 #
@@ -29,12 +44,20 @@ def rs_configure(options):
     project = options['PROJECT']
     settings = config[project]['rs']
     schema = project
+    schema_name = project
     sample_size = 10000000
     precision = 12
     number_percentiles = 10
     substr_size = 5
     hash_size = 15
     time_columns = 'timestamp'
+    # queries running at the same time, the default WLM queue has 5 slots
+    concurrency = 5
+    sample_rate = int(options['--sample'] or 0)
+    if options['--approx']:
+        distinct_error = _rs_approx_distinct_error
+    else:
+        distinct_error = 0.0
 
     aws_json = '../../etc/{proj}/aws.json'.format(proj=project)
     aws_config = load_config(aws_json)
@@ -45,46 +68,120 @@ def rs_configure(options):
     csv_tables = "rs_{project}_columns_minmax_day.csv".format(project=project)
     csv_ptiles = "rs_{project}_table_column_ptiles.csv".format(project=project)
     csv_basic = "rs_{project}_table_column_basic.csv".format(project=project)
+    sketch_dir = "rs_{project}_day_sketches".format(project=project)
+    csv_day_profile = "rs_{project}_table_column_day_profile.csv".format(project=project)
+    if sample_rate:
+        csv_ptiles = "rs_{project}_sample{rate}_table_column_ptiles.csv".format(project=project, rate=sample_rate)
+        csv_basic = "rs_{project}_sample{rate}_table_column_basic.csv".format(project=project, rate=sample_rate)
+        sketch_dir = "rs_{project}_sample{rate}_day_sketches".format(project=project, rate=sample_rate)
+        csv_day_profile = "rs_{project}_sample{rate}_table_column_day_profile.csv".format(project=project, rate=sample_rate)
 
     rs_query = rs.make_run(engine, schema)
-    list_schema = rs_make_read_column_type(rs_query, schema)
+    list_schema = make_read_cached_column_type(
+                        "rs_{project}_column_types.json".format(project=project),
+                        rs_make_read_table_versions(rs_query, schema),
+                        rs_make_read_column_type(rs_query, schema))
     schema = {(table_name, column_name): column_type
               for table_name, column_name, column_type in list_schema()}
 
     convert_string_sql = rs_make_convert_string_sql(substr_size, hash_size)
-    read_column_sql = rs_make_read_column_daily_sql(time_columns)
+    sample_filter_sql = rs_make_sample_filter_sql(schema, time_columns, sample_rate,
+                                                  _sample_ignore(project))
+    read_column_sql = rs_make_read_column_daily_sql(time_columns, sample_filter_sql)
     read_normed_percentiles_sql = rs_make_read_normed_percentiles_sql(number_percentiles)
     read_percentiles = rs_make_read_percentiles(conn, schema, number_percentiles,
                                                   convert_string_sql,
                                                   read_column_sql, read_normed_percentiles_sql)
-    read_basic_stats = rs_make_read_basic_stats(conn, schema, read_column_sql)
+    count_distinct_sql = rs_make_count_distinct_sql(distinct_error > 0)
+    read_basic_stats = rs_make_read_basic_stats(conn, schema, read_column_sql,
+                                                  count_distinct_sql, distinct_error)
+    read_table_sql = rs_make_read_table_daily_sql(schema, time_columns, sample_filter_sql)
+    read_table_basic_stats = rs_make_read_table_basic_stats(conn, read_table_sql,
+                                                  count_distinct_sql, distinct_error)
+    read_fingerprint = rs_make_read_fingerprint(rs_query, schema_name)
+    read_day_sketches = rs_make_read_day_sketches(conn, schema, convert_string_sql,
+                                                  read_column_sql,
+                                                  rs_make_read_day_sketch_sql(_sketch_size))
+    read_sketch_percentiles = make_read_sketch_percentiles(read_day_sketches,
+                                                  rs_make_read_day_fingerprints(read_fingerprint),
+                                                  sketch_dir, number_percentiles,
+                                                  options['--force'])
+    read_day_profiles = rs_make_read_profiles(conn, schema, convert_string_sql,
+                                                  read_column_sql,
+                                                  rs_make_read_profile_sql(number_percentiles,
+                                                                           count_distinct_sql, True),
+                                                  distinct_error)
+    read_full_stats = rs_make_read_profiles(conn, schema, convert_string_sql,
+                                                  read_column_sql,
+                                                  rs_make_read_profile_sql(number_percentiles,
+                                                                           count_distinct_sql, False),
+                                                  distinct_error)
     gen_tables = make_gen_csv(csv_tables)
 
-    inject = {'csv_ptiles': csv_ptiles,
+    inject = {'concurrency': concurrency,
+              'read_fingerprint': read_fingerprint,
+              'number_percentiles': number_percentiles,
+              'csv_ptiles': csv_ptiles,
               'csv_basic': csv_basic,
+              'csv_day_profile': csv_day_profile,
               'gen_tables': gen_tables,
               'read_column_percentiles': read_percentiles,
-              'read_column_basic_stats': read_basic_stats}
+              'read_sketch_percentiles': read_sketch_percentiles,
+              'read_column_basic_stats': read_basic_stats,
+              'read_table_basic_stats': read_table_basic_stats,
+              'read_column_day_profiles': read_day_profiles,
+              'read_column_full_stats': read_full_stats}
     return inject
 
 
+def rs_make_read_fingerprint(rs_query, schema):
+    '''
+    Redshift has no modification time of a table or a day
+    the row count of the table changes with every load and delete
+    '''
+    table_rows = {}
+
+    def read_fingerprint(table, start_day, end_day):
+        if not table_rows:
+            table_rows.update({table_name: str(rows) for table_name, rows in rs_query("""
+                SELECT "table", tbl_rows
+                FROM svv_table_info
+                WHERE schema = '{table_schema}'
+                """.format(table_schema=schema))})
+        return table_rows.get(table, '')
+    return read_fingerprint
+
+
+def rs_make_read_day_fingerprints(read_fingerprint):
+    '''
+    the fingerprint of the table for each day, a load into any day changes all of them
+    '''
+    def read_day_fingerprints(table, start_day, end_day):
+        fingerprint = read_fingerprint(table, start_day, end_day)
+        return {day: fingerprint for day in _days_between(start_day, end_day)}
+    return read_day_fingerprints
+
+
+def _rs_convert_sql_for(column_type, convert_string_sql):
+    return {'bigint': _rs_convert_number_sql,
+            'smallint': _rs_convert_number_sql,
+            'integer': _rs_convert_number_sql,
+            'real': _rs_convert_number_sql,
+            'double precision': _rs_convert_number_sql,
+            'character': convert_string_sql,
+            'character varying': convert_string_sql,
+            'boolean': _rs_convert_bool_sql,
+            'timestamp with time zone': _rs_convert_time_sql,
+            'timestamp without time zone': _rs_convert_time_sql,
+            'date': _rs_convert_time_sql,
+           }[column_type]
+
+
 def rs_make_read_percentiles(conn, schema, number_percentiles,
                                convert_string_sql,
                                read_column_daily_sql, read_normed_percentiles_sql):
     def read_percentiles(table, column, start_day, end_day):
-        column_type = schema[(table, column)]
-        convert = {'bigint': _rs_convert_number_sql,
-                   'smallint': _rs_convert_number_sql,
-                   'integer': _rs_convert_number_sql,
-                   'real': _rs_convert_number_sql,
-                   'double precision': _rs_convert_number_sql,
-                   'character': convert_string_sql,
-                   'character varying': convert_string_sql,
-                   'boolean': _rs_convert_bool_sql,
-                   'timestamp with time zone': _rs_convert_time_sql,
-                   'timestamp without time zone': _rs_convert_time_sql,
-                   'date': _rs_convert_time_sql,
-                  }[column_type]
+        convert = _rs_convert_sql_for(schema[(table, column)], convert_string_sql)
         sql_with = ','.join([
                         read_column_daily_sql(table, column, start_day, end_day),
                         convert(),
@@ -98,7 +195,8 @@ def rs_make_read_percentiles(conn, schema, number_percentiles,
     return read_percentiles
 
 
-def rs_make_read_basic_stats(conn, schema, read_column_daily_sql):
+def rs_make_read_basic_stats(conn, schema, read_column_daily_sql,
+                             count_distinct_sql, distinct_error):
     def read_basic_stats(table_name, column, start_day, end_day):
         column_type = schema[(table_name, column)]
         if column_type == 'boolean':
@@ -107,7 +205,8 @@ def rs_make_read_basic_stats(conn, schema, read_column_daily_sql):
             convert = _rs_basic_identity_sql
         sql_with = ','.join([read_column_daily_sql(table_name, column, start_day, end_day),
                             convert()])
-        df = pd.read_sql(_rs_read_basic_stats_sql(sql_with), con = conn)
+        df = pd.read_sql(_rs_read_basic_stats_sql(sql_with, count_distinct_sql), con = conn)
+        df['distinct_error'] = distinct_error
         return df
     return read_basic_stats
 
@@ -135,20 +234,91 @@ def _rs_basic_identity_sql():
     """
 
 
-def _rs_read_column_type_sql(schema):
+def rs_make_read_table_daily_sql(schema, time_column, sample_filter_sql):
+    def read_table_daily_sql(table, columns, start_day, end_day):
+        selects = []
+        for column in columns:
+            if schema[(table, column)] == 'boolean':
+                selects.append("""
+                CASE {column}
+                WHEN true  THEN 1
+                WHEN false THEN 0
+                END AS {column}""".format(column=column))
+            else:
+                selects.append("{column}".format(column=column))
+        return """
+        WITH
+        derived_base AS (
+            SELECT
+                {columns}
+            FROM {table}
+            WHERE date("{timestamp}") BETWEEN '{start_day}' AND '{end_day}'
+            {sample}
+            )
+        """.format(table=table,
+                columns=',\n                '.join(selects),
+                timestamp=time_column,
+                start_day=start_day,
+                end_day=end_day,
+                sample=sample_filter_sql(table, columns))
+    return read_table_daily_sql
+
+
+def rs_make_read_table_basic_stats(conn, read_table_daily_sql,
+                                   count_distinct_sql, distinct_error):
+    def read_table_basic_stats(table_name, columns, start_day, end_day):
+        sql_with = read_table_daily_sql(table_name, columns, start_day, end_day)
+        df = pd.read_sql(_rs_read_table_basic_stats_sql(sql_with, columns, count_distinct_sql),
+                         con = conn)
+        df = unpivot_basic_stats(df, columns)
+        df['distinct_error'] = distinct_error
+        return df
+    return read_table_basic_stats
+
+
+def _rs_read_column_type_sql(schema, tables):
     return """
     SELECT table_name, column_name, data_type 
     FROM information_schema.columns 
     WHERE table_schema = '{table_schema}'
-    """.format(table_schema=schema)
+    AND table_name IN ({tables})
+    """.format(table_schema=schema,
+               tables=', '.join(["'{table}'".format(table=table) for table in tables]))
 
 
 def rs_make_read_column_type(rs_query, schema):
-    def read_column_type():
-        return rs_query(_rs_read_column_type_sql(schema))
+    def read_column_type(tables):
+        # IN () is a syntax error
+        if not tables:
+            return []
+        return [tuple(row) for row in rs_query(_rs_read_column_type_sql(schema, tables))]
     return read_column_type
 
 
+def _rs_read_table_versions_sql(schema):
+    return """
+    SELECT c.relname AS table_name,
+           c.relfilenode AS file_node,
+           c.relnatts AS column_count
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = '{table_schema}'
+    AND c.relkind = 'r'
+    """.format(table_schema=schema)
+
+
+def rs_make_read_table_versions(rs_query, schema):
+    '''
+    Redshift has no modification time of a table
+    ALTER TABLE changes the column count or the file node
+    '''
+    def read_table_versions():
+        return {table_name: '{node}.{count}'.format(node=file_node, count=column_count)
+                for table_name, file_node, column_count
+                in rs_query(_rs_read_table_versions_sql(schema))}
+    return read_table_versions
+
+
 def rs_make_read_column_daily_sample(rs_query, sample_size, time_column):
     def read_column_daily_sample_sql(table, column, start_day, end_day):
         return """
@@ -214,7 +384,7 @@ def rs_crate_read_column_percentile_daily_sample_sql(sample_size, time_column):
     return read_column_percentile_daily_sample_sql
 
 
-def rs_make_read_column_daily_sql(time_column):
+def rs_make_read_column_daily_sql(time_column, sample_filter_sql):
     def read_column_daily_sql(table, column, start_day, end_day):
         return """
         WITH
@@ -225,15 +395,51 @@ def rs_make_read_column_daily_sql(time_column):
                 {column} AS event_column
             FROM {table}
             WHERE date("{timestamp}") BETWEEN '{start_day}' AND '{end_day}'
+            {sample}
             )
         """.format(table=table,
                 column=column,
                 timestamp=time_column,
                 start_day=start_day,
-                end_day=end_day)
+                end_day=end_day,
+                sample=sample_filter_sql(table, [column]))
     return read_column_daily_sql
 
 
+def _sample_key_columns(schema, table, time_column, ignore):
+    '''
+    the time column and the first other column by name, the same on both databases
+    every profiled column of a table is sampled on the same rows
+    '''
+    other = sorted(c for t, c in schema
+                   if t == table and c != time_column and c not in ignore)
+    return [time_column] + other[:1]
+
+
+def _sample_ignore(project):
+    '''
+    columns which may exist on one database only
+    '''
+    return config[project]['rs']['ignore_column'] + config[project]['bq']['ignore_column']
+
+
+def rs_make_sample_filter_sql(schema, time_column, sample_rate, ignore):
+    '''
+    keep the rows where MD5(timestamp|key column) mod sample_rate is 0
+    the values are normalized the same way as the BigQuery filter
+    so both databases keep the same rows
+    '''
+    def sample_filter_sql(table, columns):
+        if not sample_rate:
+            return ""
+        key = " || '|' || ".join([checksum.rs_normalize_column_sql(c, schema[(table, c)])
+                                  for c in _sample_key_columns(schema, table, time_column, ignore)])
+        return """
+            AND MOD(STRTOL(SUBSTRING(MD5({key}), 1, 8), 16), {rate}) = 0
+            """.format(key=key, rate=sample_rate)
+    return sample_filter_sql
+
+
 def rs_make_read_column_percentile_daily_sql(time_column):
     def read_column_percentile_daily_sql(table, column, start_day, end_day):
         return """
@@ -270,6 +476,7 @@ def _rs_convert_bool_sql():
         SELECT
             event_day,
             event_hour,
+            event_column,
             CASE event_column
             WHEN true  THEN 1
             WHEN false THEN 0
@@ -285,6 +492,7 @@ def _rs_convert_time_sql():
         SELECT
             event_day,
             event_hour,
+            event_column,
             extract(epoch from event_column) AS number_column
         FROM derived_base
         )
@@ -297,6 +505,7 @@ def _rs_convert_number_sql():
         SELECT
             event_day,
             event_hour,
+            event_column,
             event_column AS number_column
         FROM derived_base
         )
@@ -315,6 +524,7 @@ def rs_make_convert_string_sql(slice_size, hash_size):
             SELECT
                 event_day,
                 event_hour,
+                event_column,
                 SUBSTRING({parameters}) AS string_column
             FROM derived_base
             ),
@@ -323,6 +533,7 @@ def rs_make_convert_string_sql(slice_size, hash_size):
             SELECT
                 event_day,
                 event_hour,
+                event_column,
                 STRTOL(SUBSTRING(MD5(string_column),0,{no_characters}), 16) AS number_column
             FROM string_substr
             )
@@ -408,7 +619,137 @@ def rs_make_read_normed_percentiles_sql(number_percentiles):
     return read_normed_percentiles_sql
 
 
-def _rs_read_basic_stats_sql(sql_with):
+def rs_make_read_day_sketch_sql(sketch_size):
+    def read_day_sketch_sql(sql_with):
+        pcont = []
+        for idx, tile in enumerate(np.linspace(0.0, 1.0, num=sketch_size+1)):
+            pcont.append("""
+                    percentile_cont({ptile:.4f})
+                        within group (order by number_column) as q{idx:03d}
+                    """.format(ptile=tile, idx=idx))
+
+        return """
+        {sql_with}
+
+        SELECT
+            event_day,
+            count(number_column) AS row_count,
+            min(number_column) AS min_value,
+            max(number_column) AS max_value,
+            {ptiles}
+        FROM derived_number
+        WHERE number_column >= 0
+        GROUP BY event_day
+        """.format(sql_with=sql_with, ptiles=', '.join(pcont))
+    return read_day_sketch_sql
+
+
+def rs_make_read_day_sketches(conn, schema, convert_string_sql,
+                              read_column_daily_sql, read_day_sketch_sql):
+    def read_day_sketches(table, column, start_day, end_day):
+        convert = _rs_convert_sql_for(schema[(table, column)], convert_string_sql)
+        sql_with = ','.join([
+                        read_column_daily_sql(table, column, start_day, end_day),
+                        convert()])
+        return pd.read_sql(read_day_sketch_sql(sql_with), con=conn)
+    return read_day_sketches
+
+
+def _rs_day_norm_sql():
+    return """
+    derived_stats AS (
+        SELECT
+            min(number_column) AS min_value,
+            max(number_column) - min(number_column) AS range_value
+        FROM derived_number
+        WHERE number_column >= 0
+        ),
+
+    derived_day_norm AS (
+        SELECT
+            event_day,
+            event_column,
+            number_column,
+            CASE
+            WHEN number_column IS NULL OR number_column < 0
+                THEN NULL
+            WHEN (SELECT range_value from derived_stats) = 0
+                THEN 0.1
+            WHEN (number_column::float - (SELECT min_value from derived_stats)) = 0
+                THEN 0.000000000001
+            ELSE
+                (number_column::float - (SELECT min_value from derived_stats))
+                / (SELECT range_value from derived_stats)
+            END AS normed_value
+        FROM derived_number
+        )
+    """
+
+
+def rs_make_read_profile_sql(number_percentiles, count_distinct_sql, by_day):
+    '''
+    basic stats and percentiles of a column in one statement
+    per day or for the whole range
+    '''
+    def read_profile_sql(sql_with, basic_column):
+        pcont = []
+        for tile in np.linspace(0.0, 1.0, num=number_percentiles+1):
+            pcont.append("""
+                    NVL(percentile_cont({ptile:.2f})
+                        within group (order by normed_value), -1.0) as ptile_value{tile_id:02d}
+                    """.format(ptile=tile, tile_id=int(tile*100)))
+
+        return """
+        {sql_with}
+
+        SELECT
+            {day_column}
+            min({column}) AS min_value,
+            max({column}) AS max_value,
+            count({column}) AS non_null_count,
+            sum(NVL2({column}, 0, 1)) AS null_count,
+            {distinct} AS distinct_count,
+            {ptiles}
+        FROM derived_day_norm
+        {group_by}
+        """.format(sql_with=sql_with, column=basic_column,
+                   distinct=count_distinct_sql(basic_column),
+                   ptiles=', '.join(pcont),
+                   day_column='event_day,' if by_day else '',
+                   group_by='GROUP BY event_day' if by_day else '')
+    return read_profile_sql
+
+
+def rs_make_read_profiles(conn, schema, convert_string_sql, read_column_daily_sql,
+                          read_profile_sql, distinct_error):
+    def read_profiles(table, column, start_day, end_day):
+        column_type = schema[(table, column)]
+        convert = _rs_convert_sql_for(column_type, convert_string_sql)
+        sql_with = ','.join([
+                        read_column_daily_sql(table, column, start_day, end_day),
+                        convert(),
+                        _rs_day_norm_sql()])
+        # min() is not defined for boolean, use the 0/1 of the basic stats
+        if column_type == 'boolean':
+            basic_column = 'number_column'
+        else:
+            basic_column = 'event_column'
+        df = pd.read_sql(read_profile_sql(sql_with, basic_column), con=conn)
+        df['distinct_error'] = distinct_error
+        return df
+    return read_profiles
+
+
+def rs_make_count_distinct_sql(approx):
+    def count_distinct_sql(column):
+        if approx:
+            return "APPROXIMATE count(distinct {column})".format(column=column)
+        else:
+            return "count(distinct {column})".format(column=column)
+    return count_distinct_sql
+
+
+def _rs_read_basic_stats_sql(sql_with, count_distinct_sql):
     return """
     {sql_with}
 
@@ -417,9 +758,28 @@ def _rs_read_basic_stats_sql(sql_with):
         max(event_column) AS max_value,
         count(event_column) AS non_null_count,
         sum(NVL2(event_column, 0, 1)) AS null_count,
-        count(distinct event_column) AS distinct_count
+        {distinct} AS distinct_count
     FROM derived_basic_stats
-    """.format(sql_with=sql_with)
+    """.format(sql_with=sql_with, distinct=count_distinct_sql('event_column'))
+
+
+def _rs_read_table_basic_stats_sql(sql_with, columns, count_distinct_sql):
+    stats = []
+    for idx, column in enumerate(columns):
+        stats.append("""
+        min({column}) AS min_value_{idx},
+        max({column}) AS max_value_{idx},
+        count({column}) AS non_null_count_{idx},
+        sum(NVL2({column}, 0, 1)) AS null_count_{idx},
+        {distinct} AS distinct_count_{idx}""".format(column=column, idx=idx,
+                                                     distinct=count_distinct_sql(column)))
+    return """
+    {sql_with}
+
+    SELECT
+    {stats}
+    FROM derived_base
+    """.format(sql_with=sql_with, stats=','.join(stats))
 
 
 #
@@ -434,7 +794,15 @@ def bq_configure(options):
     substr_size = 5-1
     hash_size = 15-1
     time_columns = 'timestamp'
-    extend_search = 0
+    # rows loaded or streamed a day before or after their day
+    extend_search = int(options['--slack'])
+    # queries running at the same time, far below the interactive query limit
+    concurrency = 16
+    sample_rate = int(options['--sample'] or 0)
+    if options['--approx']:
+        distinct_error = _bq_approx_distinct_error
+    else:
+        distinct_error = 0.0
 
     gcp_cfg = '../../etc/{proj}/gcp.json'.format(proj=project)
     gc_client = bigquery.Client.from_service_account_json(gcp_cfg)
@@ -443,77 +811,269 @@ def bq_configure(options):
     csv_tables = "bq_{project}_columns_minmax_day.csv".format(project=project)
     csv_ptiles = "bq_{project}_table_column_ptiles.csv".format(project=project)
     csv_basic = "bq_{project}_table_column_basic.csv".format(project=project)
-
-    list_tables = bq.make_list_tables(dataset, lambda x: x)
-    schema = {(table.name, field.name): field.field_type
-                for table in list_tables()
-                for field in table.schema}
+    sketch_dir = "bq_{project}_day_sketches".format(project=project)
+    csv_day_profile = "bq_{project}_table_column_day_profile.csv".format(project=project)
+    if sample_rate:
+        csv_ptiles = "bq_{project}_sample{rate}_table_column_ptiles.csv".format(project=project, rate=sample_rate)
+        csv_basic = "bq_{project}_sample{rate}_table_column_basic.csv".format(project=project, rate=sample_rate)
+        sketch_dir = "bq_{project}_sample{rate}_day_sketches".format(project=project, rate=sample_rate)
+        csv_day_profile = "bq_{project}_sample{rate}_table_column_day_profile.csv".format(project=project, rate=sample_rate)
+
+    cost_guard = bq.make_budget_guard(gc_client, options['--budget'])
+    csv_cost = "bq_{project}_dist_cost.csv".format(project=project)
+    unpruned = options['--unpruned']
+    partition_filter_sql = bq.make_partition_filter_sql(extend_search, unpruned)
+    read_gbq = bq_make_read_gbq(settings['project'], gcp_cfg,
+                                bq.make_check_pruned(unpruned), cost_guard)
+
+    # the column types come from the table metadata, which is not a query
+    list_schema = make_read_cached_column_type(
+                        "bq_{project}_column_types.json".format(project=project),
+                        bq_make_read_table_versions(read_gbq, settings['project'],
+                                                    settings['dataset']),
+                        bq_make_read_column_type(dataset))
+    schema = {(table_name, column_name): column_type
+              for table_name, column_name, column_type in list_schema()}
 
     convert_string_sql = bq_make_convert_string_sql(substr_size, hash_size)
-    read_column_daily_sql = bq_make_read_column_daily_sql(time_columns, extend_search)
+    sample_filter_sql = bq_make_sample_filter_sql(schema, time_columns, sample_rate,
+                                                  _sample_ignore(project))
+    read_column_daily_sql = bq_make_read_column_daily_sql(time_columns, partition_filter_sql,
+                                                          sample_filter_sql)
     read_normed_percentiles_sql = bq_make_read_normed_percentiles_sql(number_percentiles)
 
-    read_percentiles = bq_make_read_percentiles(settings['project'],
+    read_percentiles = bq_make_read_percentiles(read_gbq,
                                                   settings['dataset'],
                                                   schema,
-                                                  gcp_cfg,
                                                   convert_string_sql,
                                                   read_column_daily_sql,
                                                   read_normed_percentiles_sql)
-    read_basic_stats = bq_make_read_basic_stats(settings['project'],
+    count_distinct_sql = bq_make_count_distinct_sql(distinct_error > 0)
+    read_basic_stats = bq_make_read_basic_stats(read_gbq,
                                                   settings['dataset'],
-                                                  gcp_cfg,
-                                                  read_column_daily_sql)
+                                                  read_column_daily_sql,
+                                                  count_distinct_sql, distinct_error)
+    read_table_daily_sql = bq_make_read_table_daily_sql(time_columns, partition_filter_sql,
+                                                        sample_filter_sql)
+    read_table_basic_stats = bq_make_read_table_basic_stats(read_gbq,
+                                                  settings['dataset'],
+                                                  read_table_daily_sql,
+                                                  count_distinct_sql, distinct_error)
+    read_day_sketches = bq_make_read_day_sketches(read_gbq,
+                                                  settings['dataset'],
+                                                  schema,
+                                                  convert_string_sql,
+                                                  read_column_daily_sql,
+                                                  bq_make_read_day_sketch_sql(_sketch_size))
+    read_sketch_percentiles = make_read_sketch_percentiles(read_day_sketches,
+                                                  bq_make_read_day_fingerprints(read_gbq,
+                                                                                settings['project'],
+                                                                                settings['dataset']),
+                                                  sketch_dir, number_percentiles,
+                                                  options['--force'])
+    read_day_profiles = bq_make_read_profiles(read_gbq,
+                                                  settings['dataset'],
+                                                  schema,
+                                                  convert_string_sql,
+                                                  read_column_daily_sql,
+                                                  bq_make_read_profile_sql(number_percentiles,
+                                                                           count_distinct_sql, True),
+                                                  number_percentiles, distinct_error)
+    read_full_stats = bq_make_read_profiles(read_gbq,
+                                                  settings['dataset'],
+                                                  schema,
+                                                  convert_string_sql,
+                                                  read_column_daily_sql,
+                                                  bq_make_read_profile_sql(number_percentiles,
+                                                                           count_distinct_sql, False),
+                                                  number_percentiles, distinct_error)
+    read_fingerprint = bq_make_read_fingerprint(read_gbq,
+                                                settings['project'],
+                                                settings['dataset'])
     gen_tables = make_gen_csv(csv_tables)
 
     inject = {
+            'concurrency': concurrency,
+            'cost_guard': cost_guard,
+            'csv_cost': csv_cost,
+            'read_fingerprint': read_fingerprint,
+            'number_percentiles': number_percentiles,
             'csv_ptiles': csv_ptiles,
             'csv_basic': csv_basic,
+            'csv_day_profile': csv_day_profile,
             'gen_tables': gen_tables,
             'read_column_percentiles': read_percentiles,
-            'read_column_basic_stats': read_basic_stats}
+            'read_sketch_percentiles': read_sketch_percentiles,
+            'read_column_basic_stats': read_basic_stats,
+            'read_table_basic_stats': read_table_basic_stats,
+            'read_column_day_profiles': read_day_profiles,
+            'read_column_full_stats': read_full_stats}
     return inject
 
 
-def bq_make_read_percentiles(project, dataset_name, schema, gcp_key,
+def bq_make_read_gbq(project, gcp_key, check_pruned, cost_guard=None):
+    '''
+    with a cost guard the query is capped at what is left of the budget
+    a metadata query reads no partitions and is not checked for pruning
+    '''
+    def read_gbq(sql, stage, table, legacy=False, metadata=False):
+        if not metadata:
+            check_pruned(sql, table)
+        configuration = None
+        if cost_guard is not None:
+            max_bytes = cost_guard['check'](sql, stage, table, legacy)
+            if max_bytes is not None:
+                configuration = {'query': {'maximumBytesBilled': str(max_bytes)}}
+        return pd.read_gbq(
+                    sql,
+                    dialect = 'legacy' if legacy else 'standard',
+                    project_id = project,
+                    private_key = gcp_key,
+                    configuration = configuration)
+    return read_gbq
+
+
+def bq_make_read_table_versions(read_gbq, project, dataset_name):
+    def read_table_versions():
+        df = read_gbq(
+                    """
+                    SELECT table_id, last_modified_time
+                    FROM `{project}.{dataset}.__TABLES__`
+                    """.format(project=project, dataset=dataset_name),
+                    'table_versions', dataset_name, metadata=True)
+        return {table_id: str(modified)
+                for table_id, modified in zip(df.table_id, df.last_modified_time)}
+    return read_table_versions
+
+
+def bq_make_read_column_type(dataset):
+    def read_column_type(tables):
+        column_types = []
+        for table_name in tables:
+            table = dataset.table(table_name)
+            table.reload()
+            column_types.extend([(table.name, field.name, field.field_type)
+                                 for field in table.schema])
+        return column_types
+    return read_column_type
+
+
+def bq_make_read_fingerprint(read_gbq, project, dataset_name):
+    '''
+    number of partitions and their last modification in the date range
+    '''
+    fingerprints = {}
+
+    def read_fingerprint(table, start_day, end_day):
+        key = (table, start_day, end_day)
+        if key not in fingerprints:
+            df = read_gbq(
+                    """
+                    SELECT
+                        COUNT(*) AS partitions,
+                        MAX(last_modified_time) AS last_modified
+                    FROM [{project}:{dataset}.{table}$__PARTITIONS_SUMMARY__]
+                    WHERE partition_id BETWEEN '{start_day}' AND '{end_day}'
+                    """.format(project=project, dataset=dataset_name, table=table,
+                               start_day=start_day.replace('-', ''),
+                               end_day=end_day.replace('-', '')),
+                    'fingerprint', table, legacy=True, metadata=True)
+            fingerprints[key] = '{partitions}.{modified}'.format(
+                                    partitions=df.partitions[0], modified=df.last_modified[0])
+        return fingerprints[key]
+    return read_fingerprint
+
+
+def bq_make_read_day_fingerprints(read_gbq, project, dataset_name):
+    '''
+    last modification of every partition in the date range
+    a day without a partition is missing
+    '''
+    def read_day_fingerprints(table, start_day, end_day):
+        df = read_gbq(
+                """
+                SELECT partition_id, last_modified_time
+                FROM [{project}:{dataset}.{table}$__PARTITIONS_SUMMARY__]
+                WHERE partition_id BETWEEN '{start_day}' AND '{end_day}'
+                """.format(project=project, dataset=dataset_name, table=table,
+                           start_day=start_day.replace('-', ''),
+                           end_day=end_day.replace('-', '')),
+                'fingerprint', table, legacy=True, metadata=True)
+        return {int(partition_id): str(modified)
+                for partition_id, modified in zip(df.partition_id, df.last_modified_time)}
+    return read_day_fingerprints
+
+
+def _bq_convert_sql_for(column_type, convert_string_sql):
+    return {'INTEGER': _bq_convert_number_sql,
+            'FLOAT': _bq_convert_number_sql,
+            'STRING': convert_string_sql,
+            'TIMESTAMP': _bq_convert_time_sql,
+            'BOOLEAN': _bq_convert_bool_sql,
+           }[column_type]
+
+
+def bq_make_read_percentiles(read_gbq, dataset_name, schema,
                                convert_string_sql,
                                read_column_daily_sql, read_normed_percentiles_sql):
     def read_percentiles(table_name, column, start_day, end_day):
-        column_type = schema[(table_name, column)]
-        convert = {'INTEGER': _bq_convert_number_sql,
-                   'FLOAT': _bq_convert_number_sql,
-                   'STRING': convert_string_sql,
-                   'TIMESTAMP': _bq_convert_time_sql,
-                   'BOOLEAN': _bq_convert_bool_sql,
-                  }[column_type]
+        convert = _bq_convert_sql_for(schema[(table_name, column)], convert_string_sql)
         table_name = '.'.join([dataset_name, table_name])
         sql_with = ','.join([
                          read_column_daily_sql(table_name, column, start_day, end_day),
                          convert(),
                          _bq_normalize_sql()])
-        df = pd.read_gbq(
-                    read_normed_percentiles_sql(sql_with),
-                    dialect = 'standard',
-                    project_id = project,
-                    private_key = gcp_key)
+        df = read_gbq(read_normed_percentiles_sql(sql_with), 'pctl', table_name)
         return df
     return read_percentiles
 
 
-def bq_make_read_basic_stats(project, dataset_name, gcp_key, read_column_daily_sql):
+def bq_make_read_basic_stats(read_gbq, dataset_name, read_column_daily_sql,
+                             count_distinct_sql, distinct_error):
     def read_basic_stats(table_name, column, start_day, end_day):
         table_name = '.'.join([dataset_name, table_name])
         sql_with = ','.join([read_column_daily_sql(table_name, column, start_day, end_day)])
-        df = pd.read_gbq(
-                    _bq_read_basic_stats_sql(sql_with),
-                    dialect = 'standard',
-                    project_id = project,
-                    private_key = gcp_key)
+        df = read_gbq(_bq_read_basic_stats_sql(sql_with, count_distinct_sql),
+                      'quick', table_name)
+        df['distinct_error'] = distinct_error
         return df
     return read_basic_stats
 
 
-def bq_make_read_column_daily_sql(time_column, extend_search):
+def bq_make_read_table_basic_stats(read_gbq, dataset_name, read_table_daily_sql,
+                                   count_distinct_sql, distinct_error):
+    def read_table_basic_stats(table_name, columns, start_day, end_day):
+        table_name = '.'.join([dataset_name, table_name])
+        sql_with = read_table_daily_sql(table_name, columns, start_day, end_day)
+        df = read_gbq(_bq_read_table_basic_stats_sql(sql_with, columns, count_distinct_sql),
+                      'quick', table_name)
+        df = unpivot_basic_stats(df, columns)
+        df['distinct_error'] = distinct_error
+        return df
+    return read_table_basic_stats
+
+
+def bq_make_read_table_daily_sql(time_column, partition_filter_sql, sample_filter_sql):
+    def read_table_daily_sql(table, columns, start_day, end_day):
+        return """
+        derived_base AS (
+            SELECT
+                {columns}
+            FROM {table}
+            WHERE DATE({timestamp}) BETWEEN '{start_day}'
+                                        AND '{end_day}'
+            {partition}
+            {sample}
+            )
+        """.format(table=table, columns=', '.join(columns),
+            start_day=start_day, end_day=end_day,
+            timestamp=time_column,
+            partition=partition_filter_sql(start_day, end_day),
+            sample=sample_filter_sql(table, columns))
+    return read_table_daily_sql
+
+
+def bq_make_read_column_daily_sql(time_column, partition_filter_sql, sample_filter_sql):
     def read_column_daily_sql(table, column, start_day, end_day):
         return """
         derived_base AS (
@@ -524,14 +1084,36 @@ def bq_make_read_column_daily_sql(time_column, extend_search):
             FROM {table}
             WHERE DATE({timestamp}) BETWEEN '{start_day}'
                                         AND '{end_day}'
+            {partition}
+            {sample}
             )
         """.format(table=table, column=column,
             start_day=start_day, end_day=end_day,
             timestamp=time_column,
-            extend_days=extend_search)
+            partition=partition_filter_sql(start_day, end_day),
+            sample=sample_filter_sql(table, [column]))
     return read_column_daily_sql
 
 
+def bq_make_sample_filter_sql(schema, time_column, sample_rate, ignore):
+    '''
+    keep the rows where MD5(timestamp|key column) mod sample_rate is 0
+    the values are normalized the same way as the Redshift filter
+    so both databases keep the same rows
+    '''
+    def sample_filter_sql(table, columns):
+        if not sample_rate:
+            return ""
+        # called with dataset.table
+        table = table.split('.')[-1]
+        key = ", '|', ".join([checksum.bq_normalize_column_sql(c, schema[(table, c)])
+                              for c in _sample_key_columns(schema, table, time_column, ignore)])
+        return """
+            AND MOD(CAST(CONCAT('0x', SUBSTR(TO_HEX(MD5(CONCAT({key}))), 1, 8)) AS INT64), {rate}) = 0
+            """.format(key=key, rate=sample_rate)
+    return sample_filter_sql
+
+
 def bq_make_read_column_percentile_daily_sql(percentiles, time_column, extend_search):
     def _bq_read_column_percentile_daily_sql(table, column, start_day, end_day):
         return """
@@ -580,6 +1162,7 @@ def _bq_convert_bool_sql():
         SELECT
             event_day,
             event_hour,
+            event_column,
             CASE event_column
             WHEN true  THEN 1
             WHEN false THEN 0
@@ -595,6 +1178,7 @@ def _bq_convert_time_sql():
         SELECT
             event_day,
             event_hour,
+            event_column,
             UNIX_SECONDS(event_column) AS number_column
         FROM derived_base
         )
@@ -607,6 +1191,7 @@ def _bq_convert_number_sql():
         SELECT
             event_day,
             event_hour,
+            event_column,
             event_column AS number_column
         FROM derived_base
         )
@@ -625,6 +1210,7 @@ def bq_make_convert_string_sql(slice_size, hash_size):
             SELECT
                 event_day,
                 event_hour,
+                event_column,
                 SUBSTR({parameters}) AS string_column
             FROM derived_base
             ),
@@ -633,6 +1219,7 @@ def bq_make_convert_string_sql(slice_size, hash_size):
             SELECT
                 event_day,
                 event_hour,
+                event_column,
                 CAST(CONCAT('0x', SUBSTR(TO_HEX(MD5(string_column)),0,{no_characters})) AS INT64) AS number_column
             FROM string_substr
             )
@@ -731,7 +1318,138 @@ def bq_make_read_normed_percentiles_sql(number_percentiles):
     return read_normed_percentiles_sql
 
 
-def _bq_read_basic_stats_sql(sql_with):
+def bq_make_read_day_sketch_sql(sketch_size):
+    def read_day_sketch_sql(sql_with):
+        return """
+        WITH
+        {sql_with}
+
+        SELECT
+            event_day,
+            count(number_column) AS row_count,
+            min(number_column) AS min_value,
+            max(number_column) AS max_value,
+            APPROX_QUANTILES(number_column, {sketch_size}) AS ptiles
+        FROM derived_number
+        WHERE number_column >= 0
+        GROUP BY event_day
+        """.format(sql_with=sql_with, sketch_size=sketch_size)
+    return read_day_sketch_sql
+
+
+def bq_make_read_day_sketches(read_gbq, dataset_name, schema,
+                              convert_string_sql,
+                              read_column_daily_sql, read_day_sketch_sql):
+    def read_day_sketches(table_name, column, start_day, end_day):
+        convert = _bq_convert_sql_for(schema[(table_name, column)], convert_string_sql)
+        table_name = '.'.join([dataset_name, table_name])
+        sql_with = ','.join([
+                         read_column_daily_sql(table_name, column, start_day, end_day),
+                         convert()])
+        df = read_gbq(read_day_sketch_sql(sql_with), 'sketch', table_name)
+        ptiles = pd.DataFrame(df.pop('ptiles').tolist(), index=df.index)
+        ptiles.columns = ['q{idx:03d}'.format(idx=idx) for idx in ptiles.columns]
+        return pd.concat([df, ptiles], axis=1)
+    return read_day_sketches
+
+
+def _bq_day_norm_sql():
+    return """
+    derived_stats AS (
+        SELECT
+            min(number_column) AS min_value,
+            max(number_column) - min(number_column) AS range_value
+        FROM derived_number
+        WHERE number_column >= 0
+        ),
+
+    derived_day_norm AS (
+        SELECT
+            event_day,
+            event_column,
+            number_column,
+            CASE
+            WHEN number_column IS NULL OR number_column < 0
+                THEN NULL
+            WHEN (SELECT range_value from derived_stats) = 0
+                THEN 0.1
+            WHEN (CAST(number_column AS float64) - (SELECT min_value from derived_stats)) = 0
+                THEN 0.000000000001
+            ELSE
+                (CAST(number_column AS float64) - (SELECT min_value from derived_stats))
+                / (SELECT range_value from derived_stats)
+            END AS normed_value
+        FROM derived_number
+        )
+    """
+
+
+def bq_make_read_profile_sql(number_percentiles, count_distinct_sql, by_day):
+    '''
+    basic stats and percentiles of a column in one statement
+    per day or for the whole range
+    '''
+    def read_profile_sql(sql_with, basic_column):
+        return """
+        WITH
+        {sql_with}
+
+        SELECT
+            {day_column}
+            min({column}) AS min_value,
+            max({column}) AS max_value,
+            count({column}) AS non_null_count,
+            countif({column} is NULL) AS null_count,
+            {distinct} AS distinct_count,
+            APPROX_QUANTILES(normed_value, {percentiles} IGNORE NULLS) AS ptiles
+        FROM derived_day_norm
+        {group_by}
+        """.format(sql_with=sql_with, column=basic_column,
+                   distinct=count_distinct_sql(basic_column),
+                   percentiles=number_percentiles,
+                   day_column='event_day,' if by_day else '',
+                   group_by='GROUP BY event_day' if by_day else '')
+    return read_profile_sql
+
+
+def bq_make_read_profiles(read_gbq, dataset_name, schema,
+                          convert_string_sql, read_column_daily_sql,
+                          read_profile_sql, number_percentiles, distinct_error):
+    def read_profiles(table_name, column, start_day, end_day):
+        column_type = schema[(table_name, column)]
+        convert = _bq_convert_sql_for(column_type, convert_string_sql)
+        table_name = '.'.join([dataset_name, table_name])
+        sql_with = ','.join([
+                         read_column_daily_sql(table_name, column, start_day, end_day),
+                         convert(),
+                         _bq_day_norm_sql()])
+        # same 0/1 for boolean as on Redshift
+        if column_type == 'BOOLEAN':
+            basic_column = 'number_column'
+        else:
+            basic_column = 'event_column'
+        df = read_gbq(read_profile_sql(sql_with, basic_column), 'profile', table_name)
+        # no number in the day or range gives an empty array
+        ptile_columns = _ptile_value_columns(number_percentiles)
+        ptiles = pd.DataFrame([list(p) if p is not None and len(p) else [-1.0] * len(ptile_columns)
+                               for p in df.pop('ptiles')],
+                              index=df.index, columns=ptile_columns)
+        df = pd.concat([df, ptiles.fillna(-1.0)], axis=1)
+        df['distinct_error'] = distinct_error
+        return df
+    return read_profiles
+
+
+def bq_make_count_distinct_sql(approx):
+    def count_distinct_sql(column):
+        if approx:
+            return "APPROX_COUNT_DISTINCT({column})".format(column=column)
+        else:
+            return "count(distinct {column})".format(column=column)
+    return count_distinct_sql
+
+
+def _bq_read_basic_stats_sql(sql_with, count_distinct_sql):
     return """
     WITH
     {sql_with}
@@ -741,23 +1459,337 @@ def _bq_read_basic_stats_sql(sql_with):
         max(event_column) AS max_value,
         count(event_column) AS non_null_count,
         countif(event_column is NULL) AS null_count,
-        count(distinct event_column) AS distinct_count
+        {distinct} AS distinct_count
     FROM derived_base
-    """.format(sql_with=sql_with)
+    """.format(sql_with=sql_with, distinct=count_distinct_sql('event_column'))
+
+
+def _bq_read_table_basic_stats_sql(sql_with, columns, count_distinct_sql):
+    stats = []
+    for idx, column in enumerate(columns):
+        stats.append("""
+        min({column}) AS min_value_{idx},
+        max({column}) AS max_value_{idx},
+        count({column}) AS non_null_count_{idx},
+        countif({column} is NULL) AS null_count_{idx},
+        {distinct} AS distinct_count_{idx}""".format(column=column, idx=idx,
+                                                     distinct=count_distinct_sql(column)))
+    return """
+    WITH
+    {sql_with}
 
+    SELECT
+    {stats}
+    FROM derived_base
+    """.format(sql_with=sql_with, stats=','.join(stats))
+
+
+def unpivot_basic_stats(df, columns):
+    '''
+    one row with the stats of all columns
+    to one row per column
+    '''
+    stats = ['min_value', 'max_value', 'non_null_count', 'null_count', 'distinct_count']
+    row = df.iloc[0]
+    return pd.DataFrame([
+        dict([('column_name', column)] +
+             [(stat, row['{stat}_{idx}'.format(stat=stat, idx=idx)]) for stat in stats])
+        for idx, column in enumerate(columns)])
+
+
+def make_read_cached_column_type(json_cache, read_table_versions, read_column_type):
+    '''
+    the column types of all tables are kept in a local json file
+    only the tables with a new version are read again
+    '''
+    def load_cache():
+        if not os.path.exists(json_cache):
+            return {}
+        with open(json_cache) as f:
+            return json.load(f)
+
+    def save_cache(cache):
+        with open(json_cache, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+
+    def read_cached_column_type():
+        cache = load_cache()
+        versions = read_table_versions()
+        stale = sorted(table for table, version in versions.items()
+                       if cache.get(table, {}).get('version') != version)
+
+        if stale or set(cache) != set(versions):
+            log_info("read column types of {count} tables".format(count=len(stale)))
+            columns = {table: [] for table in stale}
+            if stale:
+                for table_name, column_name, column_type in read_column_type(stale):
+                    columns[table_name].append([column_name, column_type])
+            cache = {table: cache[table] if table not in columns
+                            else {'version': versions[table], 'columns': columns[table]}
+                     for table in versions}
+            save_cache(cache)
+
+        return [(table_name, column_name, column_type)
+                for table_name, entry in cache.items()
+                for column_name, column_type in entry['columns']]
+    return read_cached_column_type
+
+
+# quantile sketch of one column on one day
+#   event_day, row_count, min_value, max_value, q000 .. q{_sketch_size}
+# stored per table and column with the fingerprint of the day,
+# days are added when a range is extended and read again when their fingerprint changed
+_sketch_size = 100
+_no_fingerprint = '-'
+
+
+def _sketch_columns():
+    return ['event_day', 'row_count', 'min_value', 'max_value'] + \
+           ['q{idx:03d}'.format(idx=idx) for idx in range(_sketch_size+1)]
+
+
+def _sketch_file_columns():
+    return _sketch_columns() + ['fingerprint']
+
+
+def _days_between(start_day, end_day):
+    return [int(day) for day in pd.date_range(start_day, end_day).strftime('%Y%m%d')]
+
+
+def _day_runs(days):
+    '''
+    sorted days in YYYYMMDD |> [(first_day, last_day), ..] of consecutive days
+    '''
+    runs = []
+    for day in days:
+        if runs and pd.to_datetime(str(day)) - pd.to_datetime(str(runs[-1][1])) == pd.Timedelta(days=1):
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+
+def merge_day_sketches(df_days, ptiles):
+    '''
+    every quantile of a day stands for row_count / (sketch_size+1) rows
+    the quantiles of the merged days are read from the weighted points
+    '''
+    df_days = df_days[df_days.row_count > 0]
+    if df_days.empty:
+        return np.full(len(ptiles), np.nan), np.nan, np.nan
+
+    q_columns = _sketch_columns()[4:]
+    values = df_days[q_columns].to_numpy(dtype=float).ravel()
+    weights = np.repeat(df_days.row_count.to_numpy(dtype=float) / len(q_columns),
+                        len(q_columns))
+    order = np.argsort(values, kind='mergesort')
+    values = values[order]
+    cum_weights = (np.cumsum(weights[order]) - weights[order] / 2) / weights.sum()
+
+    min_value = df_days.min_value.min()
+    max_value = df_days.max_value.max()
+    merged = np.interp(ptiles, cum_weights, values)
+    merged[ptiles <= 0.0] = min_value
+    merged[ptiles >= 1.0] = max_value
+    return merged, min_value, max_value
+
+
+def normalize_ptiles(ptile_values, min_value, max_value):
+    '''
+    same as the normalize sql
+    '''
+    if np.isnan(min_value):
+        return np.full(len(ptile_values), -1.0)
+    range_value = max_value - min_value
+    if range_value == 0:
+        return np.full(len(ptile_values), 0.1)
+    normed = (ptile_values - min_value) / range_value
+    normed[normed == 0] = 0.000000000001
+    return normed
+
+
+def make_read_sketch_percentiles(read_day_sketches, read_day_fingerprints, sketch_dir,
+                                 number_percentiles, force=False):
+    '''
+    scan only the days which have no sketch yet or a changed fingerprint
+    answer the percentiles from the merged day sketches
+    force drops the stored sketches of a column before it is read
+    '''
+    os.makedirs(sketch_dir, exist_ok=True)
+
+    def sketch_file(table, column):
+        return os.path.join(sketch_dir, "{table}.{column}.csv".format(table=table, column=column))
+
+    def load_sketches(csv_sketch):
+        if force or not os.path.exists(csv_sketch):
+            return pd.DataFrame(columns=_sketch_file_columns())
+        # sketches stored without a fingerprint are stale
+        return pd.read_csv(csv_sketch, header=None, names=_sketch_file_columns(),
+                           dtype={'fingerprint': str})
+
+    def fingerprint_of(fingerprints):
+        return lambda day: fingerprints.get(int(day), _no_fingerprint)
+
+    def drop_stale(table, column, df_sketches, days, fingerprints):
+        '''
+        the days of the range whose partition changed since their sketch was read
+        are removed from the file, they are read again
+        '''
+        stale = df_sketches.event_day.isin(days) & \
+                (df_sketches.fingerprint != df_sketches.event_day.map(fingerprint_of(fingerprints)))
+        if not (force or stale.any()):
+            return df_sketches
+        if stale.any():
+            log_info("{count} day sketches of {table}.{column} are stale".format(
+                        count=stale.sum(), table=table, column=column))
+        df_sketches = df_sketches[~stale]
+        df_sketches.to_csv(sketch_file(table, column), header=False, index=False,
+                           columns=_sketch_file_columns())
+        return df_sketches
+
+    def read_run(table, column, first_day, last_day):
+        start_day, end_day = [pd.to_datetime(str(day)).strftime('%Y-%m-%d')
+                              for day in (first_day, last_day)]
+        log_info("read day sketches for {table}.{column} {start}..{end}".format(
+                    table=table, column=column, start=start_day, end=end_day))
+        df_new = read_day_sketches(table, column, start_day, end_day)
+        # no rows in the range comes back without the q columns
+        df_new = df_new.reindex(columns=_sketch_columns())
+        df_new['event_day'] = df_new.event_day.astype(int)
+        df_empty = pd.DataFrame({'event_day': [day for day in _days_between(start_day, end_day)
+                                               if day not in set(df_new.event_day)],
+                                 'row_count': 0})
+        df_new = pd.concat([df_new, df_empty], ignore_index=True)
+        return df_new.reindex(columns=_sketch_columns())
+
+    def update_sketches(table, column, df_sketches, days, fingerprints):
+        missing = sorted(set(days) - set(df_sketches.event_day))
+        if not missing:
+            return df_sketches
+        df_new = pd.concat([read_run(table, column, first_day, last_day)
+                            for first_day, last_day in _day_runs(missing)],
+                           ignore_index=True)
+        df_new = df_new.astype({'event_day': int, 'row_count': int})
+        df_new = df_new.assign(fingerprint=df_new.event_day.map(fingerprint_of(fingerprints)))
+        df_new.to_csv(sketch_file(table, column), mode='a', header=False, index=False,
+                      columns=_sketch_file_columns())
+        return pd.concat([df_sketches, df_new], ignore_index=True)
 
-def make_process_stats(name, read_stats, process_result, sort_columns, csv_file, csv_columns):
-    def write_to_csv(results, csv_out):
-        df = pd.concat(results)
-        df = df.sort_values(sort_columns)
-        df.to_csv(csv_out, header=False, index=False, columns=csv_columns)
+    def read_percentiles(table, column, start_day, end_day):
+        days = _days_between(start_day, end_day)
+        # taken before the read, a load during the read leaves the day stale
+        fingerprints = read_day_fingerprints(table, start_day, end_day)
+        df_sketches = load_sketches(sketch_file(table, column))
+        df_sketches = drop_stale(table, column, df_sketches, days, fingerprints)
+        df_sketches = update_sketches(table, column, df_sketches, days, fingerprints)
+        df_days = df_sketches[df_sketches.event_day.isin(days)]
+
+        ptiles = np.linspace(0.0, 1.0, num=number_percentiles+1)
+        merged, min_value, max_value = merge_day_sketches(df_days, ptiles)
+        return pd.DataFrame({
+            'ptile': ptiles,
+            'ptile_value': normalize_ptiles(merged, min_value, max_value)
+            })
+    return read_percentiles
 
+
+def _group_tables(tables):
+    '''
+    one group per table, also when its columns are not next to each other
+    the groups are in the order the tables first appear
+    '''
+    tables_grouped = {}
+    for table, column, start_day, end_day in tables:
+        tables_grouped.setdefault(table, []).append((table, column, start_day, end_day))
+    return list(tables_grouped.values())
+
+
+def _csv_for(csv_file, table_name):
     csv_name, csv_suffix = csv_file.split('.')
+    return "{name}_{table}.{suffix}".format(name=csv_name, table=table_name, suffix=csv_suffix)
+
+
+def make_checkpoint(checkpoint_file, read_fingerprint, force=False, variant=()):
+    '''
+    a line per (stats kind, table, column, date range) which is done
+    with the fingerprint of the source data taken before it was read
+    a column is fresh when its line has the current fingerprint
+    variant are the options which change the stats, they are part of the kind
+    force makes every column stale
+    '''
+    import csv
+    import threading
+    lock = threading.Lock()
+    done = {}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            for kind, table, column, start_day, end_day, fingerprint in csv.reader(f):
+                done[(kind, table, column, start_day, end_day)] = fingerprint
+
+    def kind_of(kind):
+        return '+'.join([kind] + list(variant))
+
+    def is_fresh(kind, table, column, start_day, end_day):
+        fingerprint = done.get((kind_of(kind), table, column, start_day, end_day))
+        return not force and fingerprint is not None and \
+               fingerprint == read_fingerprint(table, start_day, end_day)
+
+    def read_fingerprints(table_group):
+        return [read_fingerprint(table, start_day, end_day)
+                for table, _, start_day, end_day in table_group]
+
+    def mark_done(kind, table_group, fingerprints):
+        rows = [(kind_of(kind), table, column, start_day, end_day, fingerprint)
+                for (table, column, start_day, end_day), fingerprint
+                in zip(table_group, fingerprints)]
+        with lock:
+            with open(checkpoint_file, 'a') as f:
+                csv.writer(f).writerows(rows)
+            for row in rows:
+                done[row[:5]] = row[5]
+
+    return {'is_fresh': is_fresh,
+            'read_fingerprints': read_fingerprints,
+            'mark_done': mark_done}
+
+
+def _checkpoint_file(csv_file):
+    return csv_file.replace('.csv', '.checkpoint')
+
+
+def _stale_groups(name, tables_grouped, csv_files, checkpoint):
+    '''
+    a table is read again when one of its columns is stale
+    or one of its csv files is missing
+    its csv has the rows of all its columns
+    '''
+    if checkpoint is None:
+        return tables_grouped
+    stale = []
+    for table_group in tables_grouped:
+        table = table_group[0][0]
+        if all(os.path.exists(_csv_for(csv_file, table)) for csv_file in csv_files) and \
+           all(checkpoint['is_fresh'](name, *table_column) for table_column in table_group):
+            log_info("{name} for {table} are fresh".format(name=name, table=table))
+        else:
+            stale.append(table_group)
+    return stale
 
 
-    def csv_for(table_name):
-        return "{name}_{table}.{suffix}".format(name=csv_name, table=table_name, suffix=csv_suffix)
+def make_process_stats(name, read_stats, process_result, sort_columns, csv_file, csv_columns,
+                       concurrency=16, write_table=None, checkpoint=None, other_csv_files=()):
+    '''
+    one pool for the columns of all tables
+    the csv of a table is written when its last column is done
+    write_table(df, table) replaces the csv for other outputs,
+    other_csv_files are the other csv files it writes
+    tables with fresh stats in the checkpoint are skipped
+    '''
+    def write_to_csv(df, table):
+        df.to_csv(_csv_for(csv_file, table), header=False, index=False, columns=csv_columns)
 
+    if write_table is None:
+        write_table = write_to_csv
 
     def run_stats(table_column):
         table, column, start_day, end_day = table_column
@@ -769,54 +1801,151 @@ def make_process_stats(name, read_stats, process_result, sort_columns, csv_file,
         return df
 
 
-    def group_the(tables):
-        current_table = ''
-        table_group = []
-        tables_grouped = []
+    def process_stats(tables):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        tables_grouped = [group for group in _group_tables(tables) if group]
+        tables_grouped = _stale_groups(name, tables_grouped,
+                                       [csv_file] + list(other_csv_files), checkpoint)
+        groups = {group[0][0]: group for group in tables_grouped}
+        # taken before the read, a load during the read leaves the table stale
+        fingerprints = {}
+        if checkpoint is not None:
+            fingerprints = {table: checkpoint['read_fingerprints'](group)
+                            for table, group in groups.items()}
+        pending = {table: len(group) for table, group in groups.items()}
+        results = {table: [] for table in groups}
+        errors = []
+
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        futures = {pool.submit(run_stats, table_column): table_column
+                   for table_group in tables_grouped
+                   for table_column in table_group}
+        try:
+            # the results are gathered and written in this thread,
+            # the workers only read
+            for future in as_completed(futures):
+                table, column, _, _ = futures[future]
+                try:
+                    df = future.result()
+                except bq.BudgetExceeded:
+                    # the queued columns are cancelled below
+                    raise
+                except Exception as error:
+                    log_info("failed {name} for {table}.{column}: {error}".format(
+                                name=name, table=table, column=column, error=error))
+                    errors.append(error)
+                    continue
+                results[table].append(df)
+                pending[table] -= 1
+                if pending[table] == 0:
+                    df = pd.concat(results.pop(table)).sort_values(sort_columns)
+                    write_table(df, table)
+                    if checkpoint is not None:
+                        checkpoint['mark_done'](name, groups[table], fingerprints[table])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+
+        if errors:
+            raise errors[0]
 
-        for table, column, start_day, end_day in tables:
-            if not current_table:
-                current_table = table
-            if current_table != table:
-                tables_grouped.append(table_group)
-                current_table = table
-                table_group = []
-            table_group.append((table, column, start_day, end_day))
-        tables_grouped.append(table_group)
+    return process_stats
 
-        return tables_grouped
+
+def make_process_table_stats(name, read_table_stats, process_result, sort_columns, csv_file, csv_columns,
+                             concurrency=4, checkpoint=None):
+    '''
+    one query per table for all its columns
+    '''
+    def run_stats(table_group):
+        table, _, start_day, end_day = table_group[0]
+        columns = [column for _, column, _, _ in table_group]
+        log_info("read {name} for {count} columns of {table}".format(
+                    name=name, count=len(columns), table=table))
+        if checkpoint is not None:
+            fingerprints = checkpoint['read_fingerprints'](table_group)
+        df = read_table_stats(table, columns, start_day, end_day)
+        df['table_name'] = table
+        df = process_result(df)
+        df = df.sort_values(sort_columns)
+        df.to_csv(_csv_for(csv_file, table), header=False, index=False, columns=csv_columns)
+        if checkpoint is not None:
+            checkpoint['mark_done'](name, table_group, fingerprints)
 
 
     def process_stats(tables):
-        tables_grouped = group_the(tables)
-
-        from multiprocessing.pool import ThreadPool
-        for table_group in tables_grouped:
-            pool = ThreadPool(processes=16)
-            results = pool.map(run_stats, table_group)
-            pool.close()
-            pool.join()
-            table_name = table_group[0][0]
-            write_to_csv(results, csv_for(table_name))
- 
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        tables_grouped = [group for group in _group_tables(tables) if group]
+        tables_grouped = _stale_groups(name, tables_grouped, [csv_file], checkpoint)
+
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [pool.submit(run_stats, table_group) for table_group in tables_grouped]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # over the budget or a failed table, the queued tables are not read
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+
     return process_stats
 
 
-def read_basic_stats(tables, column_basic_stats, csv_out):
+def _basic_csv_columns(approx):
+    columns = ['table_name', 'column_name',
+               'min_value', 'max_value',
+               'non_null_count', 'null_count',
+               'distinct_count']
+    if approx:
+        columns.append('distinct_error')
+    return columns
+
+
+def _ptile_value_columns(number_percentiles):
+    return ['ptile_value{tile_id:02d}'.format(tile_id=int(tile*100))
+            for tile in np.linspace(0.0, 1.0, num=number_percentiles+1)]
+
+
+def _day_profile_csv_columns(number_percentiles, approx):
+    columns = _basic_csv_columns(approx)
+    return columns[:2] + ['event_day'] + columns[2:] + _ptile_value_columns(number_percentiles)
+
+
+def read_basic_stats(tables, column_basic_stats, csv_out, approx=False, concurrency=16,
+                     checkpoint=None):
     process_stats = make_process_stats(
                                 'basic stats',
                                 column_basic_stats,
                                 lambda df: df, 
                                 ['table_name', 'column_name'],
                                 csv_out,
-                                ['table_name', 'column_name',
-                                'min_value', 'max_value',
-                                'non_null_count', 'null_count',
-                                'distinct_count'])
+                                _basic_csv_columns(approx),
+                                concurrency,
+                                checkpoint=checkpoint)
     process_stats(tables)
 
 
-def read_percentiles(tables, column_percentiles, csv_out):
+def read_table_basic_stats(tables, table_basic_stats, csv_out, approx=False, concurrency=4,
+                           checkpoint=None):
+    process_stats = make_process_table_stats(
+                                'basic stats',
+                                table_basic_stats,
+                                lambda df: df,
+                                ['table_name', 'column_name'],
+                                csv_out,
+                                _basic_csv_columns(approx),
+                                concurrency,
+                                checkpoint=checkpoint)
+    process_stats(tables)
+
+
+def read_percentiles(tables, column_percentiles, csv_out, concurrency=16, checkpoint=None):
     def format_ptiles(df):
         df['ptile'] = df['ptile'].apply(lambda x: '{0:.2f}'.format(x))
         df['ptile_value'] = df['ptile_value'].apply(lambda x: '{0:.12f}'.format(x))
@@ -828,7 +1957,63 @@ def read_percentiles(tables, column_percentiles, csv_out):
                                 format_ptiles,
                                 ['table_name', 'column_name', 'ptile'],
                                 csv_out,
-                                ['table_name', 'column_name', 'ptile', 'ptile_value'])
+                                ['table_name', 'column_name', 'ptile', 'ptile_value'],
+                                concurrency,
+                                checkpoint=checkpoint)
+    process_stats(tables)
+
+
+def read_day_profiles(tables, column_day_profiles, csv_out, number_percentiles,
+                      approx=False, concurrency=16, checkpoint=None):
+    def format_profiles(df):
+        for column in _ptile_value_columns(number_percentiles):
+            df[column] = df[column].apply(lambda x: '{0:.12f}'.format(x))
+        return df
+
+    process_stats = make_process_stats(
+                                'day profiles',
+                                column_day_profiles,
+                                format_profiles,
+                                ['table_name', 'column_name', 'event_day'],
+                                csv_out,
+                                _day_profile_csv_columns(number_percentiles, approx),
+                                concurrency,
+                                checkpoint=checkpoint)
+    process_stats(tables)
+
+
+def read_full_stats(tables, column_full_stats, csv_ptiles, csv_basic, number_percentiles,
+                    approx=False, concurrency=16, checkpoint=None):
+    '''
+    one query per column
+    |> split into the rows of the basic csv and the ptiles csv
+    '''
+    ptile_columns = _ptile_value_columns(number_percentiles)
+
+    def write_both(df, table):
+        df.to_csv(_csv_for(csv_basic, table), header=False, index=False,
+                  columns=_basic_csv_columns(approx))
+
+        df_ptiles = df.melt(id_vars=['table_name', 'column_name'], value_vars=ptile_columns,
+                            var_name='ptile', value_name='ptile_value')
+        df_ptiles['ptile'] = df_ptiles.ptile.str.replace('ptile_value', '').astype(int) / 100.0
+        df_ptiles = df_ptiles.sort_values(['table_name', 'column_name', 'ptile'])
+        df_ptiles['ptile'] = df_ptiles['ptile'].apply(lambda x: '{0:.2f}'.format(x))
+        df_ptiles['ptile_value'] = df_ptiles['ptile_value'].apply(lambda x: '{0:.12f}'.format(x))
+        df_ptiles.to_csv(_csv_for(csv_ptiles, table), header=False, index=False,
+                         columns=['table_name', 'column_name', 'ptile', 'ptile_value'])
+
+    process_stats = make_process_stats(
+                                'full stats',
+                                column_full_stats,
+                                lambda df: df,
+                                ['table_name', 'column_name'],
+                                csv_basic,
+                                None,
+                                concurrency,
+                                write_both,
+                                checkpoint,
+                                [csv_ptiles])
     process_stats(tables)
 
 
@@ -838,33 +2023,89 @@ def main(options):
     elif options['--bq']:
         inject = bq_configure(options)
 
-    if options['--pctl']:
+    def checkpoint_for(csv_file):
+        variant = [option.lstrip('-') for option in ['--approx', '--sketch'] if options[option]]
+        if options['--sample']:
+            variant.append('sample{percent}'.format(percent=options['--sample']))
+        return make_checkpoint(_checkpoint_file(csv_file), inject['read_fingerprint'],
+                               options['--force'], variant)
+
+    if options['--pctl'] and options['--sketch']:
+        db_read_percentiles = inject['read_sketch_percentiles']
+        csv_ptiles = inject['csv_ptiles']
+        gen_tables = inject['gen_tables']
+        read_percentiles(gen_tables, db_read_percentiles, csv_ptiles,
+                         inject['concurrency'], checkpoint_for(csv_ptiles))
+    elif options['--pctl']:
         db_read_percentiles = inject['read_column_percentiles']
         csv_ptiles = inject['csv_ptiles']
         gen_tables = inject['gen_tables']
-        read_percentiles(gen_tables, db_read_percentiles, csv_ptiles)
+        read_percentiles(gen_tables, db_read_percentiles, csv_ptiles,
+                         inject['concurrency'], checkpoint_for(csv_ptiles))
+    elif options['--quick'] and options['--per-table']:
+        db_read_basic_stats = inject['read_table_basic_stats']
+        csv_basic = inject['csv_basic']
+        gen_tables = inject['gen_tables']
+        read_table_basic_stats(gen_tables, db_read_basic_stats, csv_basic,
+                               options['--approx'], inject['concurrency'],
+                               checkpoint_for(csv_basic))
     elif options['--quick']:
         db_read_basic_stats = inject['read_column_basic_stats']
         csv_basic = inject['csv_basic']
         gen_tables = inject['gen_tables']
-        read_basic_stats(gen_tables, db_read_basic_stats, csv_basic)
+        read_basic_stats(gen_tables, db_read_basic_stats, csv_basic,
+                         options['--approx'], inject['concurrency'],
+                         checkpoint_for(csv_basic))
+    elif options['--full']:
+        db_read_full_stats = inject['read_column_full_stats']
+        gen_tables = inject['gen_tables']
+        read_full_stats(gen_tables, db_read_full_stats,
+                        inject['csv_ptiles'], inject['csv_basic'],
+                        inject['number_percentiles'],
+                        options['--approx'], inject['concurrency'],
+                        checkpoint_for(inject['csv_basic']))
+    elif options['--daily']:
+        db_read_day_profiles = inject['read_column_day_profiles']
+        csv_day_profile = inject['csv_day_profile']
+        gen_tables = inject['gen_tables']
+        read_day_profiles(gen_tables, db_read_day_profiles, csv_day_profile,
+                          inject['number_percentiles'],
+                          options['--approx'], inject['concurrency'],
+                          checkpoint_for(csv_day_profile))
+
+    if inject.get('cost_guard'):
+        bq.write_cost_report(inject['cost_guard'], inject['csv_cost'])
 
 
 _usage="""
 Calculate column stats
 
 Usage:
-  db_dist (--rs | --bq) (--pctl | --quick) PROJECT
+  db_dist (--rs | --bq) (--pctl [--sketch] | --quick [--per-table] [--approx] | --full [--approx] | --daily [--approx]) [--sample=<n>] [--force] [--slack=<d>] [--unpruned] [--budget=<gb>] PROJECT
 
 Arguments:
   PROJECT    name of the project
 
 Options:
-  -h --help   show this
-  --rs        use Redshift
-  --bq        use Bigquery
-  --pctl      calculate percentiles
-  --quick     calculate min,max,distinct,..
+  -h --help      show this
+  --rs           use Redshift
+  --bq           use Bigquery
+  --pctl         calculate percentiles
+  --sketch       merge stored day sketches, only days without a sketch
+                 or with a reloaded partition are read
+  --quick        calculate min,max,distinct,..
+  --per-table    one query per table for all its columns
+  --full         percentiles and min,max,distinct,.. in one query per column
+  --daily        min,max,distinct,.. and percentiles per day in one query per column
+  --approx       approximate distinct counts, adds the relative error to the csv
+  --sample=<n>   keep 1 in n rows, the same rows on Redshift and BigQuery
+  --force        read all tables, also those with fresh stats in the checkpoint,
+                 and drop the stored day sketches
+  --slack=<d>    rows are at most d days from the partition of their day [default: 1]
+  --unpruned     allow queries without _PARTITIONTIME filter, for tables without partitions
+  --budget=<gb>  dry run the BigQuery queries, stop before the run scans more GB
+                 and write the bytes per table to a cost csv,
+                 one query per table scans every column only once
 """
 
 from docopt import docopt
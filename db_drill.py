@@ -0,0 +1,266 @@
+'''
+Drill down into the days where the Redshift and BigQuery row counts differ.
+
+the mismatching (table, day) pairs are read from the db_diff output
+    db_diff --validator=absolute --printer=csv_all
+rows are counted per bucket on both databases, only inside the mismatching buckets
+buckets which still differ are split into finer buckets
+
+    day |> hour |> 5 minutes |> minute
+
+one query per table and level on each database
+'''
+
+from google.cloud import bigquery
+import datetime
+import pandas as pd
+
+from config import config, load_config
+from lib import make_gen_csv, log_info
+import rs
+
+
+_levels = [3600, 300, 60]
+
+
+#
+# --> RedShift
+#
+def rs_configure(project):
+    settings = config[project]['rs']
+    schema = settings['schema']
+    time_column = 'timestamp'
+
+    aws_json = '../../etc/{proj}/aws.json'.format(proj=project)
+    aws_config = load_config(aws_json)
+    engine = rs.connect(project, aws_config)
+    conn = engine.connect()
+    conn.execute("SET search_path TO {schema}".format(schema=schema))
+
+    count_buckets_sql = rs_make_count_buckets_sql(time_column)
+    read_buckets = rs_make_read_buckets(conn, count_buckets_sql)
+
+    inject = {'read_buckets': read_buckets}
+    return inject
+
+
+def _rs_bucket_range_sql(time_column, start, end):
+    return """
+    ("{timestamp}" >= TIMESTAMP 'epoch' + {start} * INTERVAL '1 second'
+     AND "{timestamp}" < TIMESTAMP 'epoch' + {end} * INTERVAL '1 second')
+    """.format(timestamp=time_column, start=start, end=end)
+
+
+def rs_make_count_buckets_sql(time_column):
+    def count_buckets_sql(table, buckets, bucket_size):
+        ranges = ' OR '.join([_rs_bucket_range_sql(time_column, start, start + size)
+                              for start, size in buckets])
+        return """
+        SELECT
+            floor(extract(epoch from "{timestamp}") / {size})::bigint * {size} AS bucket_start,
+            count(*) AS total_rows
+        FROM {table}
+        WHERE {ranges}
+        GROUP BY 1
+        """.format(table=table, timestamp=time_column,
+                   size=bucket_size, ranges=ranges)
+    return count_buckets_sql
+
+
+def rs_make_read_buckets(conn, count_buckets_sql):
+    def read_buckets(table, buckets, bucket_size):
+        return pd.read_sql(count_buckets_sql(table, buckets, bucket_size), con=conn)
+    return read_buckets
+
+
+#
+# --> BigQuery
+#
+def bq_configure(project):
+    settings = config[project]['bq']
+    time_column = 'timestamp'
+    extend_search = 1
+
+    gcp_cfg = '../../etc/{proj}/gcp.json'.format(proj=project)
+
+    count_buckets_sql = bq_make_count_buckets_sql(time_column, extend_search)
+    read_buckets = bq_make_read_buckets(settings['project'],
+                                        settings['dataset'],
+                                        gcp_cfg,
+                                        count_buckets_sql)
+
+    inject = {'read_buckets': read_buckets}
+    return inject
+
+
+def _bq_bucket_range_sql(time_column, start, end):
+    return """
+    ({timestamp} >= TIMESTAMP_SECONDS({start})
+     AND {timestamp} < TIMESTAMP_SECONDS({end}))
+    """.format(timestamp=time_column, start=start, end=end)
+
+
+def bq_make_count_buckets_sql(time_column, extend_search):
+    def count_buckets_sql(table, buckets, bucket_size):
+        ranges = ' OR '.join([_bq_bucket_range_sql(time_column, start, start + size)
+                              for start, size in buckets])
+        first = min(start for start, _ in buckets)
+        last = max(start + size for start, size in buckets)
+        return """
+        SELECT
+            DIV(UNIX_SECONDS({timestamp}), {size}) * {size} AS bucket_start,
+            COUNT(*) AS total_rows
+        FROM {table}
+        WHERE _PARTITIONTIME
+            BETWEEN TIMESTAMP(DATE_SUB(DATE(TIMESTAMP_SECONDS({first})), INTERVAL {extend_days} DAY))
+            AND TIMESTAMP(DATE_ADD(DATE(TIMESTAMP_SECONDS({last})), INTERVAL {extend_days} DAY))
+        AND ({ranges})
+        GROUP BY bucket_start
+        """.format(table=table, timestamp=time_column,
+                   size=bucket_size, ranges=ranges,
+                   first=first, last=last,
+                   extend_days=extend_search)
+    return count_buckets_sql
+
+
+def _empty_buckets():
+    return pd.DataFrame({'bucket_start': pd.Series(dtype='int64'),
+                         'total_rows': pd.Series(dtype='int64')})
+
+
+def bq_make_read_buckets(project, dataset_name, gcp_key, count_buckets_sql):
+    def read_buckets(table_name, buckets, bucket_size):
+        table_name = '.'.join([dataset_name, table_name])
+        df = pd.read_gbq(
+                    count_buckets_sql(table_name, buckets, bucket_size),
+                    dialect = 'standard',
+                    project_id = project,
+                    private_key = gcp_key)
+        # no rows in the buckets comes back without columns
+        if df.empty:
+            return _empty_buckets()
+        return df
+    return read_buckets
+
+
+#
+# FUNCTIONALITY
+#
+def day_to_bucket(on_day):
+    '''
+    on_day in format 20170930 or 2017-09-30
+    a bucket is (start in epoch seconds, size in seconds)
+    '''
+    day = datetime.datetime.strptime(str(on_day).replace('-', ''), '%Y%m%d')
+    start = int((day - datetime.datetime(1970, 1, 1)).total_seconds())
+    return (start, 86400)
+
+
+def read_mismatch_days(csv_diff):
+    '''
+    the first two columns of the db_diff csv output are tablename,on_day
+    '''
+    mismatch = {}
+    for row in make_gen_csv(csv_diff):
+        table, on_day = row[0], row[1]
+        mismatch.setdefault(table, []).append(day_to_bucket(on_day))
+    return mismatch
+
+
+def make_count_level(rs_read_buckets, bq_read_buckets):
+    def count_level(table, buckets, bucket_size):
+        log_info("count {table} in {count} buckets of {size}s".format(
+                    table=table, count=len(buckets), size=bucket_size))
+        df_rs = rs_read_buckets(table, buckets, bucket_size)
+        df_bq = bq_read_buckets(table, buckets, bucket_size)
+        df = pd.merge(df_rs, df_bq, how='outer', on='bucket_start',
+                      suffixes=('_rs', '_bq'))
+        df = df.fillna(0).astype('int64')
+        df['tablename'] = table
+        df['bucket_size'] = bucket_size
+        df['absolute_diff'] = df.total_rows_bq - df.total_rows_rs
+        return df[df.absolute_diff != 0]
+    return count_level
+
+
+def drill_down(mismatch, count_level, levels=_levels):
+    '''
+    mismatching buckets
+    |> count_level
+    |> keep differing buckets
+    |> next level
+    '''
+    results = []
+    for table, buckets in mismatch.items():
+        for bucket_size in levels:
+            if not buckets:
+                break
+            df = count_level(table, buckets, bucket_size)
+            results.append(df)
+            buckets = [(int(start), bucket_size) for start in df.bucket_start]
+
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results)
+
+
+def write_to_csv(df, csv_out):
+    if df.empty:
+        log_info("no differences below day level")
+        return
+    df['bucket_time'] = pd.to_datetime(df.bucket_start, unit='s')
+    df = df.sort_values(['tablename', 'bucket_start', 'bucket_size'],
+                        ascending=[True, True, False])
+    df.to_csv(csv_out, header=False, index=False,
+              columns=['tablename', 'bucket_time', 'bucket_size',
+                       'total_rows_rs', 'total_rows_bq', 'absolute_diff'])
+
+
+def main(options):
+    project = options['PROJECT']
+
+    if options['--in']:
+        csv_diff = options['--in']
+    else:
+        csv_diff = "verify_{project}.csv".format(project=project)
+
+    if options['--out']:
+        csv_out = options['--out']
+    else:
+        csv_out = "drill_{project}.csv".format(project=project)
+
+    levels = _levels[:int(options['--depth'])]
+
+    rs_inject = rs_configure(project)
+    bq_inject = bq_configure(project)
+    count_level = make_count_level(rs_inject['read_buckets'],
+                                   bq_inject['read_buckets'])
+
+    mismatch = read_mismatch_days(csv_diff)
+    df = drill_down(mismatch, count_level, levels)
+    write_to_csv(df, csv_out)
+
+
+_usage="""
+Count rows in hourly and finer buckets, only for the days db_diff reported
+Create csv with tablename,bucket_time,bucket_size,rows_rs,rows_bq,diff
+
+Usage:
+  db_drill [--in=<i>] [--out=<o>] [--depth=<d>] PROJECT
+
+Arguments:
+  PROJECT    name of the project
+
+Options:
+  -h --help     show this
+  --in=<i>      read tablename,on_day from this db_diff output
+  --out=<o>     write differing buckets to this file
+  --depth=<d>   1 hour, 2 five minutes, 3 minute [default: 3]
+"""
+
+from docopt import docopt
+
+
+if __name__ == '__main__':
+    options = docopt(_usage)
+    main(options)
@@ -0,0 +1,190 @@
+'''
+Migrate again the partitions where the row counts differ until they match.
+
+    diff
+    |> migrate the differing partitions
+    |> count the rows of these partitions on Redshift and BigQuery
+    |> update the count files
+    |> diff
+
+stops when no partition differs or after a number of rounds
+only the differing partitions are migrated and counted
+a partition whose migration failed is not counted, it is reported on its own
+
+the migrator runs only the load step of bigshift,
+it loads again the unload of the partition which is in the bucket
+rows missing in that unload are missing again after the rerun,
+unload the partition again before the rerun to get them
+'''
+
+from multiprocessing.pool import ThreadPool
+import subprocess
+import pandas as pd
+
+import db_count
+import db_diff
+from lib import log_info, pp
+
+
+def configure(options):
+    project = options['PROJECT']
+
+    settings = {
+        'prod-bora-bq': {'migrator': ['bash', 'bora_migrate_partition.sh']},
+        'prod-ostro-bq': {'migrator': ['bash', 'ostro_migrate_partition.sh']},
+        'dev-ostro-bq': {'migrator': ['bash', 'ostro_migrate_partition.sh']},
+        }[project]
+
+    files = {db: {'csv_count': "{db}_{project}_table_daily_rows.csv".format(db=db, project=project)}
+             for db in ['rs', 'bq']}
+
+    count_options = {'PROJECT': project,
+                     '--daily': True, '--whole': False,
+                     '--in': None, '--out': None}
+    rs_inject = db_count.rs_configure(count_options)
+    bq_inject = db_count.bq_configure(count_options)
+
+    inject = {
+        'migrate': make_migrate(settings['migrator'], int(options['--jobs'])),
+        'rs_count': db_count.make_count_daily(rs_inject['read_count']),
+        'bq_count': db_count.make_count_daily(bq_inject['read_count']),
+        'files': files,
+        'csv_partition': "bq_{project}_table_partitions.csv".format(project=project),
+        'ignore': ['storm_warn', 'weather_adjust'],
+        }
+    return inject
+
+
+def make_migrate(migrator, jobs):
+    def migrate_partition(partition):
+        table, on_day = partition
+        log_info("migrate {table} {day}".format(table=table, day=on_day))
+        return subprocess.call(migrator + [table, str(on_day)])
+
+    def migrate(partitions):
+        pool = ThreadPool(processes=jobs)
+        results = pool.map(migrate_partition, partitions)
+        pool.close()
+        pool.join()
+        failed = [p for p, code in zip(partitions, results) if code != 0]
+        for table, on_day in failed:
+            log_info("migration failed for {table} {day}".format(table=table, day=on_day))
+        return failed
+    return migrate
+
+
+def _iso_day(on_day):
+    day = str(on_day)
+    return '-'.join([day[:4], day[4:6], day[6:]])
+
+
+def differing_partitions(df_cmp):
+    '''
+    a day missing on one side has no count and is a difference too
+    '''
+    df = df_cmp[~(df_cmp.absolute_diff == 0)]
+    return [(str(table), int(on_day)) for table, on_day in df.index]
+
+
+def recount(partitions, count_daily, jobs=8):
+    '''
+    count every partition on its own
+    a partition without rows is counted as 0
+    '''
+    def count_partition(partition):
+        table, on_day = partition
+        return list(count_daily((table, _iso_day(on_day), _iso_day(on_day))))
+
+    pool = ThreadPool(processes=jobs)
+    results = pool.map(count_partition, partitions)
+    pool.close()
+    pool.join()
+
+    df_zero = pd.DataFrame(partitions, columns=['tablename', 'on_day'])
+    df_zero['total_rows'] = 0
+    df = pd.DataFrame([item for result in results for item in result],
+                      columns=['tablename', 'on_day', 'total_rows'])
+    df['on_day'] = db_diff._day_key(df.on_day.astype(str))
+    df = pd.concat([df, df_zero]).drop_duplicates(['tablename', 'on_day'])
+    return df
+
+
+def update_counts(csv_count, df_recount):
+    '''
+    replace the counts of the recounted partitions
+    '''
+    df = db_diff._load_daily(csv_count, []).astype({'tablename': str})
+    df = pd.concat([df_recount, df]).drop_duplicates(['tablename', 'on_day'])
+    df = df.sort_values(['tablename', 'on_day'])
+    df['on_day'] = df.on_day.apply(_iso_day)
+    df.to_csv(csv_count, header=False, index=False,
+              columns=['tablename', 'on_day', 'total_rows'])
+
+
+def rerun(inject, rounds):
+    '''
+    |> (partitions which still differ, partitions whose last migration failed)
+    a failed partition keeps its old counts and is tried again in the next round
+    '''
+    files = inject['files']
+    failed = set()
+
+    for round_no in range(1, rounds + 1):
+        df_cmp = db_diff.compare(files['rs']['csv_count'], files['bq']['csv_count'],
+                                 inject['csv_partition'], inject['ignore'])
+        partitions = differing_partitions(df_cmp)
+        log_info("round {no}: {count} partitions differ".format(no=round_no, count=len(partitions)))
+        if not partitions:
+            return [], sorted(failed)
+
+        round_failed = set(inject['migrate'](partitions))
+        failed = (failed - set(partitions)) | round_failed
+        migrated = [p for p in partitions if p not in round_failed]
+        if not migrated:
+            continue
+
+        for db in ['rs', 'bq']:
+            df_recount = recount(migrated, inject[db + '_count'])
+            update_counts(files[db]['csv_count'], df_recount)
+
+    df_cmp = db_diff.compare(files['rs']['csv_count'], files['bq']['csv_count'],
+                             inject['csv_partition'], inject['ignore'])
+    differ = [p for p in differing_partitions(df_cmp) if p not in failed]
+    return differ, sorted(failed)
+
+
+def main(options):
+    inject = configure(options)
+    partitions, failed = rerun(inject, int(options['--rounds']))
+
+    if failed:
+        log_info("{count} partitions failed to migrate".format(count=len(failed)))
+        pp(pd.DataFrame(failed, columns=['tablename', 'on_day']))
+    if partitions:
+        log_info("{count} partitions still differ".format(count=len(partitions)))
+        pp(pd.DataFrame(partitions, columns=['tablename', 'on_day']))
+    elif not failed:
+        log_info("all partitions match")
+
+
+_usage="""
+Migrate the differing partitions again until the rs and bq row counts match
+
+Usage:
+  db_rerun [--rounds=<r>] [--jobs=<j>] PROJECT
+
+Arguments:
+  PROJECT    name of the project
+
+Options:
+  -h --help       show this
+  --rounds=<r>    give up after this many rounds [default: 3]
+  --jobs=<j>      partitions migrated at the same time [default: 8]
+"""
+
+from docopt import docopt
+
+
+if __name__ == '__main__':
+    options = docopt(_usage)
+    main(options)
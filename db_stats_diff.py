@@ -0,0 +1,255 @@
+'''
+Compare the column stats db_dist wrote for Redshift and BigQuery
+
+all per-table csv files of a project are loaded at once
+rs and bq are aligned with one join per kind of stats
+
+per column
+    max_ptile_delta  largest difference of a normalized percentile
+    psi              population stability index of the bq values
+                     in the bins between the rs percentiles
+    null_delta       difference of the NULL ratios
+    distinct_ratio   larger / smaller distinct count
+    minmax_match     min and max are equal
+
+min and max are compared by the BigQuery column type db_dist cached,
+timestamps as instants, booleans as 0/1 and numbers as numbers
+
+approximate distinct counts match within the sum of their errors
+    |rs - bq| <= rs * rs_error + bq * bq_error
+the error bound of each database is in the csv, db_dist documents where it comes from
+exact distinct counts have an error of 0
+
+only columns over a threshold are reported
+ranked by the metric which is the furthest over its threshold
+'''
+
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from lib import log_info, pp
+
+
+_basic_columns = ['table_name', 'column_name',
+                  'min_value', 'max_value',
+                  'non_null_count', 'null_count',
+                  'distinct_count', 'distinct_error']
+
+_ptile_columns = ['table_name', 'column_name', 'ptile', 'ptile_value']
+
+
+def _read_basic_csv(csv_file):
+    df = pd.read_csv(csv_file, header=None, dtype={2: str, 3: str})
+    df.columns = _basic_columns[:len(df.columns)]
+    if 'distinct_error' not in df.columns:
+        df['distinct_error'] = 0.0
+    return df
+
+
+def _read_ptile_csv(csv_file):
+    return pd.read_csv(csv_file, header=None, names=_ptile_columns)
+
+
+def load_stats(csv_pattern, read_csv, columns):
+    '''
+    all per-table csv files of a database
+    '''
+    csv_files = sorted(glob.glob(csv_pattern))
+    log_info("read {count} files {pattern}".format(count=len(csv_files), pattern=csv_pattern))
+    if not csv_files:
+        return pd.DataFrame(columns=columns)
+    return pd.concat([read_csv(csv_file) for csv_file in csv_files],
+                     ignore_index=True)
+
+
+def load_column_types(json_cache):
+    '''
+    the column types db_dist keeps in {db}_{project}_column_types.json
+    '''
+    rows = []
+    if os.path.exists(json_cache):
+        with open(json_cache) as f:
+            cache = json.load(f)
+        rows = [(table_name, column_name, column_type)
+                for table_name, entry in cache.items()
+                for column_name, column_type in entry['columns']]
+    else:
+        log_info("no column types in {cache}, min and max are compared as text".format(cache=json_cache))
+    return pd.DataFrame(rows, columns=['table_name', 'column_name', 'column_type'])
+
+
+_numeric_types = ['INTEGER', 'FLOAT', 'NUMERIC']
+_time_types = ['TIMESTAMP', 'DATETIME', 'DATE']
+_bool_values = {'true': 1, 't': 1, '1': 1, '1.0': 1,
+                'false': 0, 'f': 0, '0': 0, '0.0': 0}
+
+
+def _normalize_minmax(values, column_type):
+    if column_type in _numeric_types:
+        return pd.to_numeric(values, errors='coerce')
+    if column_type in _time_types:
+        return pd.to_datetime(values, utc=True, errors='coerce')
+    if column_type == 'BOOLEAN':
+        return values.astype(str).str.lower().map(_bool_values)
+    return values.where(values.isna(), values.astype(str).str.rstrip())
+
+
+def _is_value_match(rs_values, bq_values, column_type):
+    rs_values = _normalize_minmax(rs_values, column_type)
+    bq_values = _normalize_minmax(bq_values, column_type)
+    both_null = rs_values.isna() & bq_values.isna()
+    if column_type in _numeric_types:
+        return pd.Series(np.isclose(rs_values, bq_values, rtol=1e-9), index=rs_values.index) | both_null
+    return (rs_values == bq_values) | both_null
+
+
+def is_minmax_match(df_cmp):
+    match = pd.Series(True, index=df_cmp.index)
+    for column_type, df in df_cmp.groupby(df_cmp.column_type.fillna('STRING')):
+        match[df.index] = _is_value_match(df.min_value_rs, df.min_value_bq, column_type) \
+                        & _is_value_match(df.max_value_rs, df.max_value_bq, column_type)
+    return match
+
+
+def is_distinct_match(df_cmp):
+    tolerance = df_cmp.distinct_count_rs * df_cmp.distinct_error_rs \
+              + df_cmp.distinct_count_bq * df_cmp.distinct_error_bq
+    return (df_cmp.distinct_count_rs - df_cmp.distinct_count_bq).abs() <= tolerance
+
+
+def diff_basic_stats(df_rs, df_bq, df_types):
+    df_cmp = pd.merge(df_rs, df_bq, how='inner',
+                      on=['table_name', 'column_name'],
+                      suffixes=('_rs', '_bq'))
+    df_cmp = pd.merge(df_cmp, df_types, how='left', on=['table_name', 'column_name'])
+
+    null_ratio_rs = df_cmp.null_count_rs / (df_cmp.null_count_rs + df_cmp.non_null_count_rs)
+    null_ratio_bq = df_cmp.null_count_bq / (df_cmp.null_count_bq + df_cmp.non_null_count_bq)
+    distinct_min = np.minimum(df_cmp.distinct_count_rs, df_cmp.distinct_count_bq)
+    distinct_max = np.maximum(df_cmp.distinct_count_rs, df_cmp.distinct_count_bq)
+
+    df = df_cmp[['table_name', 'column_name']].copy()
+    df['null_delta'] = (null_ratio_rs - null_ratio_bq).abs().fillna(0.0)
+    df['distinct_ratio'] = (distinct_max / distinct_min.where(distinct_min > 0)).fillna(1.0)
+    df.loc[is_distinct_match(df_cmp), 'distinct_ratio'] = 1.0
+    df['minmax_match'] = is_minmax_match(df_cmp)
+    return df
+
+
+def _psi(df_cmp, min_share=0.0001):
+    '''
+    cdf of bq at the rs percentiles by linear interpolation
+    every column is shifted by 10 * its group id, so one np.interp
+    handles all columns and clamps at the ends of each column
+    values are normalized to [0, 1], NULL percentiles are -1
+    '''
+    group_id = df_cmp.groupby(['table_name', 'column_name'], sort=False).ngroup().to_numpy()
+    shift = 10.0 * group_id
+    cdf_bq = np.interp(df_cmp.ptile_value_rs.to_numpy() + shift,
+                       df_cmp.ptile_value_bq.to_numpy() + shift,
+                       df_cmp.ptile.to_numpy() + group_id) - group_id
+
+    df = df_cmp[['table_name', 'column_name']].copy()
+    df['share_bq'] = np.diff(cdf_bq, prepend=0.0)
+    df['share_rs'] = np.diff(df_cmp.ptile.to_numpy(), prepend=0.0)
+    # the first percentile of a column opens the first bin
+    first = df_cmp.ptile.to_numpy() == 0.0
+    df = df[~first]
+    share_bq = df.share_bq.clip(lower=min_share)
+    share_rs = df.share_rs.clip(lower=min_share)
+    df['psi'] = (share_bq - share_rs) * np.log(share_bq / share_rs)
+    return df.groupby(['table_name', 'column_name'], sort=False)['psi'].sum()
+
+
+def diff_ptiles(df_rs, df_bq):
+    df_cmp = pd.merge(df_rs, df_bq, how='inner',
+                      on=['table_name', 'column_name', 'ptile'],
+                      suffixes=('_rs', '_bq'))
+    df_cmp = df_cmp.sort_values(['table_name', 'column_name', 'ptile'], ignore_index=True)
+
+    df_cmp['ptile_delta'] = (df_cmp.ptile_value_rs - df_cmp.ptile_value_bq).abs()
+    groups = df_cmp.groupby(['table_name', 'column_name'], sort=False)
+    df = groups['ptile_delta'].max().rename('max_ptile_delta').to_frame()
+    df['psi'] = _psi(df_cmp)
+    return df.reset_index()
+
+
+def rank(df, thresholds):
+    '''
+    score is the largest metric / threshold, over 1 means reported
+    '''
+    scores = pd.DataFrame({metric: df[metric] / threshold
+                           for metric, threshold in thresholds.items()
+                           if metric in df})
+    if 'distinct_ratio' in scores:
+        scores['distinct_ratio'] = (df.distinct_ratio - 1.0) / (thresholds['distinct_ratio'] - 1.0)
+    df['score'] = scores.max(axis=1)
+    if 'minmax_match' in df:
+        df.loc[df.minmax_match == False, 'score'] = df.score.clip(lower=1.0 + 1e-9)
+    df = df[df.score > 1.0]
+    return df.sort_values('score', ascending=False)
+
+
+def compare_stats(csv_pattern, thresholds, df_types):
+    df_rs_basic = load_stats(csv_pattern.format(db='rs', kind='basic'), _read_basic_csv, _basic_columns)
+    df_bq_basic = load_stats(csv_pattern.format(db='bq', kind='basic'), _read_basic_csv, _basic_columns)
+    df_rs_ptiles = load_stats(csv_pattern.format(db='rs', kind='ptiles'), _read_ptile_csv, _ptile_columns)
+    df_bq_ptiles = load_stats(csv_pattern.format(db='bq', kind='ptiles'), _read_ptile_csv, _ptile_columns)
+
+    df_basic = diff_basic_stats(df_rs_basic, df_bq_basic, df_types)
+    df_ptiles = diff_ptiles(df_rs_ptiles, df_bq_ptiles)
+    df = pd.merge(df_ptiles, df_basic, how='outer', on=['table_name', 'column_name'])
+    return rank(df, thresholds)
+
+
+def main(options):
+    project = options['PROJECT']
+    df_types = load_column_types("bq_{project}_column_types.json".format(project=project))
+    if options['--sample']:
+        project = "{project}_sample{rate}".format(project=project, rate=options['--sample'])
+    csv_pattern = "{{db}}_{project}_table_column_{{kind}}_*.csv".format(project=project)
+    csv_out = "stats_diff_{project}.csv".format(project=project)
+
+    thresholds = {'max_ptile_delta': float(options['--max-delta']),
+                  'psi': float(options['--psi']),
+                  'null_delta': float(options['--null-delta']),
+                  'distinct_ratio': float(options['--distinct-ratio'])}
+    if thresholds['distinct_ratio'] <= 1.0:
+        raise ValueError("--distinct-ratio has to be larger than 1, it is {ratio}".format(
+                            ratio=options['--distinct-ratio']))
+
+    df = compare_stats(csv_pattern, thresholds, df_types)
+
+    log_info("{count} columns over threshold".format(count=len(df)))
+    pp(df)
+    df.to_csv(csv_out, index=False)
+
+
+_usage="""
+Compare the rs and bq column stats
+Create csv with the columns over threshold, the most different first
+
+Usage:
+  db_stats_diff [--sample=<n>] [--max-delta=<d>] [--psi=<p>] [--null-delta=<z>] [--distinct-ratio=<r>] PROJECT
+
+Arguments:
+  PROJECT    name of the project
+
+Options:
+  -h --help             show this
+  --sample=<n>          compare the stats of db_dist --sample=<n>
+  --max-delta=<d>       largest allowed percentile difference [default: 0.05]
+  --psi=<p>             largest allowed population stability index [default: 0.1]
+  --null-delta=<z>      largest allowed NULL ratio difference [default: 0.01]
+  --distinct-ratio=<r>  largest allowed distinct count ratio, larger than 1 [default: 1.05]
+"""
+
+from docopt import docopt
+
+
+if __name__ == '__main__':
+    options = docopt(_usage)
+    main(options)
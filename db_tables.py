@@ -257,9 +257,19 @@ def bq_configure(options):
 
     read_columns = bq_make_read_columns()
     put_columns = bq_make_columns(read_columns)
-    read_min_day = bq_make_read_min_day(gc_client, settings['dataset'])
+    cost_guard = bq.make_budget_guard(gc_client, options['--budget'])
+    csv_cost = "bq_{project}_tables_cost.csv".format(project=project)
+    # rows loaded or streamed a day before or after their day
+    slack_days = int(options['--slack'])
+    unpruned = options['--unpruned']
+    partition_filter_sql = bq.make_partition_filter_sql(slack_days, unpruned)
+    check_pruned = bq.make_check_pruned(unpruned)
+    read_partition_range = bq_make_read_partition_range(gc_client, settings['dataset'])
+    read_min_day = bq_make_read_min_day(gc_client, settings['dataset'], read_partition_range,
+                                        partition_filter_sql, check_pruned, unpruned, cost_guard)
     put_min_day = bq_make_min_day(read_min_day)
-    read_max_day = bq_make_read_max_day(gc_client, settings['dataset'])
+    read_max_day = bq_make_read_max_day(gc_client, settings['dataset'], read_partition_range,
+                                        partition_filter_sql, check_pruned, unpruned, cost_guard)
     put_max_day = bq_make_max_day(read_max_day)
     read_partitions = bq_make_read_partitions(gc_client, settings['dataset'])
     put_partitions = bq_make_partitions(read_partitions)
@@ -288,12 +298,16 @@ def bq_configure(options):
             'csv_tables': csv_tables,
             'csv_columns': csv_columns,
             'csv_partition': csv_partition,
+            'cost_guard': cost_guard,
+            'csv_cost': csv_cost,
             }
     return inject
 
 
-def bq_run_query(client, sql):
+def bq_run_query(client, sql, cost_guard=None, stage=None, table=None):
     query_job = client.run_async_query(str(uuid.uuid4()), sql)
+    if cost_guard is not None:
+        query_job.maximum_bytes_billed = cost_guard['check'](sql, stage, table, legacy=True)
     query_job.begin()
     query_job.result()
     destination_table = query_job.destination
@@ -346,19 +360,56 @@ def bq_make_columns(read_columns):
     return put_columns
 
 
-def _bq_read_min_day_sql(table):
+def _bq_read_partition_range_sql(table):
+    return """
+    SELECT
+        MIN(partition_id) AS first_partition,
+        MAX(partition_id) AS last_partition
+    FROM [{table}$__PARTITIONS_SUMMARY__]
+    WHERE partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+    """.format(table=table)
+
+
+def bq_make_read_partition_range(client, dataset_name):
+    '''
+    first and last partition from the metadata, no bytes are billed
+    '''
+    def read_partition_range(table_name):
+        table = '.'.join([dataset_name, table_name])
+        for r in bq_run_query(client, _bq_read_partition_range_sql(table)):
+            return r[0], r[1]
+        return None, None
+    return read_partition_range
+
+
+def _bq_read_min_day_sql(table, partition_filter):
     return """
     SELECT
         MIN(date(timestamp)) as min_day
     FROM [{tablename}]
     WHERE date(timestamp) < CURRENT_DATE()
-    """.format(tablename=table)
+    {partition}
+    """.format(tablename=table, partition=partition_filter)
 
 
-def bq_make_read_min_day(client, dataset_name):
-    def read_min_day(table):
-        table = '.'.join([dataset_name, table])
-        result = bq_run_query(client, _bq_read_min_day_sql(table))
+def bq_make_read_min_day(client, dataset_name, read_partition_range, partition_filter_sql,
+                         check_pruned, unpruned=False, cost_guard=None):
+    '''
+    the rows of the first day are in the partitions around the first partition
+    '''
+    def read_min_day(table_name):
+        table = '.'.join([dataset_name, table_name])
+        if unpruned:
+            sql = _bq_read_min_day_sql(table, "")
+        else:
+            first_partition, _ = read_partition_range(table_name)
+            if first_partition is None:
+                # no partition, no rows
+                yield None
+                return
+            sql = _bq_read_min_day_sql(table, partition_filter_sql(first_partition, first_partition))
+        check_pruned(sql, table_name)
+        result = bq_run_query(client, sql, cost_guard, 'min_day', table_name)
         for r in result:
             yield r[0]
     return read_min_day
@@ -371,18 +422,33 @@ def bq_make_min_day(read_min_day):
     return put_min_day
 
 
-def bq_make_read_max_day(client, dataset_name):
-    def read_max_day_sql(table):
+def bq_make_read_max_day(client, dataset_name, read_partition_range, partition_filter_sql,
+                         check_pruned, unpruned=False, cost_guard=None):
+    '''
+    the rows of the last day are in the partitions around the last partition
+    '''
+    def read_max_day_sql(table, partition_filter):
         return """
         SELECT
             MAX(date(timestamp)) as max_day
         FROM [{tablename}]
         WHERE date(timestamp) < CURRENT_DATE()
-        """.format(tablename=table)
+        {partition}
+        """.format(tablename=table, partition=partition_filter)
 
-    def read_max_day(table):
-        table = '.'.join([dataset_name, table])
-        result = bq_run_query(client, read_max_day_sql(table))
+    def read_max_day(table_name):
+        table = '.'.join([dataset_name, table_name])
+        if unpruned:
+            sql = read_max_day_sql(table, "")
+        else:
+            _, last_partition = read_partition_range(table_name)
+            if last_partition is None:
+                # no partition, no rows
+                yield None
+                return
+            sql = read_max_day_sql(table, partition_filter_sql(last_partition, last_partition))
+        check_pruned(sql, table_name)
+        result = bq_run_query(client, sql, cost_guard, 'max_day', table_name)
         for r in result:
             yield r[0]
     return read_max_day
@@ -566,6 +632,9 @@ def main(options):
     results = process(f_tables, func_list)
     export_list(results, csv_out, csv_columns)
 
+    if inject.get('cost_guard'):
+        bq.write_cost_report(inject['cost_guard'], inject['csv_cost'])
+
 
 # Options probably must start with a unique letter
 # --rsload and --rsunload does not work
@@ -573,21 +642,25 @@ _usage="""
 Export the requested table list into csv
 
 Usage:
-  db_tables (--rs | --bq) (--daily | --whole) (--tables | --columns | --part) PROJECT END_DAY
+  db_tables (--rs | --bq) (--daily | --whole) (--tables | --columns | --part) [--slack=<d>] [--unpruned] [--budget=<gb>] PROJECT END_DAY
 
 Arguments:
   PROJECT    name of the project
   END_DAY    upper bound in YYYYMMDD for an operation, for example --verify
 
 Options:
-  -h --help   show this
-  --rs        use Redshift
-  --bq        use Bigquery
-  --daily     only tables with time-column (events, facts)
-  --whole     only tables with no time-column (dimensions)
-  --tables    create csv with tablename,min_day,max_day
-  --columns   create csv with tablename,columnname,min_day,max_day
-  --part      create csv with tablename,partition
+  -h --help      show this
+  --rs           use Redshift
+  --bq           use Bigquery
+  --daily        only tables with time-column (events, facts)
+  --whole        only tables with no time-column (dimensions)
+  --tables       create csv with tablename,min_day,max_day
+  --columns      create csv with tablename,columnname,min_day,max_day
+  --part         create csv with tablename,partition
+  --slack=<d>    rows are at most d days from the partition of their day [default: 1]
+  --unpruned     allow queries without _PARTITIONTIME filter, for tables without partitions
+  --budget=<gb>  dry run the BigQuery queries, stop before the run scans more GB
+                 and write the bytes per table to a cost csv
 """
 
 from docopt import docopt
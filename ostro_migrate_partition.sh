@@ -10,6 +10,9 @@
 #
 # partition in format
 #   20170930
+#
+# the cutoff day is optional, it is passed to bigshift only when given
+# a failed load exits with 1 and logs tablename::partition
 
 
 tablename="$1"
@@ -19,13 +22,40 @@ bigshift_home="${HOME}/workspace/bigshift"
 
 
 cd ${bigshift_home}
-bundle exec ./bin/bigshift --steps load \
+gcp_credentials="./etc/prod-ostro/gcp.json"
+gcp_project="zephyrus-ef4-prod-ostro"
+
+
+# bigshift appends to the partition
+# drop it first, so a rerun replaces the rows instead of duplicating them
+# with the credentials and project of the load, only a missing partition is ignored
+if [[ -n "$partition" ]]; then
+    if ! rm_output=$(CLOUDSDK_AUTH_CREDENTIAL_FILE_OVERRIDE="$gcp_credentials" \
+            bq --project_id="$gcp_project" rm -f -t "ostro.${tablename}\$${partition}" 2>&1); then
+        if [[ "$rm_output" != *"Not found"* ]]; then
+            echo "$rm_output" >&2
+            exit 1
+        fi
+    fi
+fi
+
+# only the callers which know a cutoff day pass it
+cutoff_args=()
+if [[ -n "$cutoff" ]]; then
+    cutoff_args=(--cutoff-day "$cutoff")
+fi
+
+# the partition is already dropped, a failed load leaves it empty
+if ! bundle exec ./bin/bigshift --steps load \
     --rs-database ef4 --rs-schema ostro --rs-table "$tablename" \
     --rs-credentials ~/.aws/rs_ostro.yml \
     --s3-bucket zephyrus-ef4-prod-ostro-migrate \
-    --gcp-credentials ./etc/prod-ostro/gcp.json \
+    --gcp-credentials "$gcp_credentials" \
     --cs-bucket zephyrus-ef4-prod-ostro-migrate --bq-dataset ostro \
     --no-compression \
-    --partition-day "$partition"
-    --cutoff-day "$cutoff"
-    --time-column "timestamp"
+    --partition-day "$partition" \
+    "${cutoff_args[@]}" \
+    --time-column "timestamp"; then
+    echo "${tablename}::load failed, partition ${partition} is empty" >&2
+    exit 1
+fi
@@ -0,0 +1,101 @@
+import decimal
+import math
+import re
+
+import pytest
+
+import db_checksum
+
+
+def _round(x, digits):
+    # ROUND on both databases rounds half away from zero
+    # a double has at most 309 digits before the point
+    return float(decimal.Decimal(x).quantize(decimal.Decimal(1).scaleb(-digits),
+                                             rounding=decimal.ROUND_HALF_UP,
+                                             context=decimal.Context(prec=400)))
+
+
+def _exponent(x):
+    return math.floor(math.log10(abs(x)))
+
+
+def _rs_decimal(x, digits):
+    # CAST(.. AS DECIMAL(38,d)) AS VARCHAR
+    return str(decimal.Decimal(repr(x)).quantize(decimal.Decimal(1).scaleb(-digits)))
+
+
+# the Redshift and BigQuery parts of the float normalization with the column v,
+# each evaluated the way its database does
+_rs_parts = {
+    "\"v\" = 'NaN'::float": lambda x: math.isnan(x),
+    "\"v\" = 'Infinity'::float": lambda x: x == math.inf,
+    "\"v\" = '-Infinity'::float": lambda x: x == -math.inf,
+    "ROUND(\"v\", 6) = 0": lambda x: _round(x, 6) == 0,
+    "ABS(\"v\") >= 1e15": lambda x: abs(x) >= 1e15,
+    "CAST(CAST(ROUND(\"v\" / POWER(10, FLOOR(LOG(ABS(\"v\")))), 9) AS DECIMAL(38,9)) AS VARCHAR)"
+    " || 'e' || CAST(CAST(FLOOR(LOG(ABS(\"v\"))) AS BIGINT) AS VARCHAR)":
+        lambda x: _rs_decimal(_round(x / 10.0 ** _exponent(x), 9), 9) + 'e' + str(_exponent(x)),
+    "CAST(CAST(ROUND(\"v\", 6) AS DECIMAL(38,6)) AS VARCHAR)":
+        lambda x: _rs_decimal(_round(x, 6), 6),
+    }
+
+_bq_parts = {
+    "IS_NAN(`v`)": lambda x: math.isnan(x),
+    "IS_INF(`v`) AND `v` > 0": lambda x: x == math.inf,
+    "IS_INF(`v`) AND `v` < 0": lambda x: x == -math.inf,
+    "ROUND(`v`, 6) = 0": lambda x: _round(x, 6) == 0,
+    "ABS(`v`) >= 1e15": lambda x: abs(x) >= 1e15,
+    "CONCAT(FORMAT('%.9f', ROUND(`v` / POW(10, FLOOR(LOG10(ABS(`v`)))), 9)),"
+    " 'e', CAST(CAST(FLOOR(LOG10(ABS(`v`))) AS INT64) AS STRING))":
+        lambda x: '%.9f' % _round(x / 10.0 ** _exponent(x), 9) + 'e' + str(_exponent(x)),
+    "FORMAT('%.6f', ROUND(`v`, 6))":
+        lambda x: '%.6f' % _round(x, 6),
+    }
+
+
+def _evaluate(case_sql, parts, x):
+    '''
+    CASE WHEN cond THEN result .. ELSE result END for the value x
+    '''
+    whens = re.findall(r"WHEN (.+?) THEN (.+?)(?= WHEN | ELSE )", case_sql)
+    otherwise = re.search(r" ELSE (.+) END$", case_sql).group(1)
+    for cond, result in whens:
+        if parts[cond](x):
+            break
+    else:
+        result = otherwise
+    if result.startswith("'"):
+        return result.strip("'")
+    return parts[result](x)
+
+
+def _normalize(db, x):
+    if db == 'rs':
+        return _evaluate(db_checksum._rs_normalize['double precision'].format(c='"v"'), _rs_parts, x)
+    return _evaluate(db_checksum._bq_normalize['FLOAT'].format(c='`v`'), _bq_parts, x)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (-0.0, '0.000000'),
+    (-0.0000001, '0.000000'),
+    (float('nan'), '<nan>'),
+    (float('inf'), '<inf>'),
+    (float('-inf'), '<-inf>'),
+    (1.5e20, '1.500000000e20'),
+    (-9.87654321e35, '-9.876543210e35'),
+    (-2.0000005, '-2.000001'),
+    (12.25, '12.250000'),
+    ])
+def test_float_normalization_is_the_same_on_both_databases(value, expected):
+    assert _normalize('rs', value) == expected
+    assert _normalize('bq', value) == expected
+
+
+def test_numeric_uses_the_float_normalization():
+    assert db_checksum._rs_normalize['numeric'] == db_checksum._rs_normalize['double precision']
+    assert db_checksum._bq_normalize['NUMERIC'] == db_checksum._bq_normalize['FLOAT']
+
+
+def test_unknown_type_raises():
+    with pytest.raises(ValueError):
+        db_checksum.bq_normalize_column_sql('v', 'GEOGRAPHY')
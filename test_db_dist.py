@@ -0,0 +1,104 @@
+import pandas as pd
+
+import db_dist
+
+
+def make_fake_read_gbq(modified):
+    '''
+    answers the fingerprint query with the last modification in modified[table]
+    '''
+    def read_gbq(sql, stage, table, legacy=False, metadata=False):
+        assert stage == 'fingerprint' and legacy and metadata
+        return pd.DataFrame({'partitions': [3], 'last_modified': [modified[table]]})
+    return read_gbq
+
+
+def make_counting_read_stats(reads):
+    def read_stats(table, column, start_day, end_day):
+        reads.append((table, column))
+        return pd.DataFrame({'min_value': [0], 'max_value': [1]})
+    return read_stats
+
+
+def run_basic_stats(modified, reads):
+    # the fingerprints are cached per run, a new run reads them again
+    read_fingerprint = db_dist.bq_make_read_fingerprint(make_fake_read_gbq(modified),
+                                                        'project', 'dataset')
+    checkpoint = db_dist.make_checkpoint(db_dist._checkpoint_file('basic.csv'),
+                                         read_fingerprint, variant=['approx'])
+    process_stats = db_dist.make_process_stats(
+                                'basic stats',
+                                make_counting_read_stats(reads),
+                                lambda df: df,
+                                ['table_name', 'column_name'],
+                                'basic.csv',
+                                ['table_name', 'column_name', 'min_value', 'max_value'],
+                                2, None, checkpoint)
+    process_stats([('fresh', 'a', '2017-09-01', '2017-09-30'),
+                   ('fresh', 'b', '2017-09-01', '2017-09-30'),
+                   ('reloaded', 'a', '2017-09-01', '2017-09-30')])
+
+
+def test_checkpoint_skips_unchanged_and_reads_changed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modified = {'fresh': 1506729600, 'reloaded': 1506729600}
+
+    reads = []
+    run_basic_stats(modified, reads)
+    assert sorted(reads) == [('fresh', 'a'), ('fresh', 'b'), ('reloaded', 'a')]
+
+    modified['reloaded'] += 3600
+    reads = []
+    run_basic_stats(modified, reads)
+    assert reads == [('reloaded', 'a')]
+
+
+def test_checkpoint_kind_includes_the_variant(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    checkpoint = db_dist.make_checkpoint('basic.checkpoint', lambda *args: 'v1',
+                                         variant=['approx'])
+    checkpoint['mark_done']('basic stats', [('t', 'a', '2017-09-01', '2017-09-30')], ['v1'])
+
+    same = db_dist.make_checkpoint('basic.checkpoint', lambda *args: 'v1', variant=['approx'])
+    exact = db_dist.make_checkpoint('basic.checkpoint', lambda *args: 'v1')
+    assert same['is_fresh']('basic stats', 't', 'a', '2017-09-01', '2017-09-30')
+    assert not exact['is_fresh']('basic stats', 't', 'a', '2017-09-01', '2017-09-30')
+
+
+def make_fake_read_day_sketches(reads):
+    def read_day_sketches(table, column, start_day, end_day):
+        reads.append((start_day, end_day))
+        days = db_dist._days_between(start_day, end_day)
+        sketch = {'event_day': days, 'row_count': 10, 'min_value': 0.0, 'max_value': 1.0}
+        sketch.update({q_column: 0.5 for q_column in db_dist._sketch_columns()[4:]})
+        return pd.DataFrame(sketch)
+    return read_day_sketches
+
+
+def test_sketches_of_a_reloaded_day_are_read_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modified = {20170901: '1', 20170902: '1', 20170903: '1'}
+
+    def read_percentiles(reads, force=False):
+        return db_dist.make_read_sketch_percentiles(
+                    make_fake_read_day_sketches(reads),
+                    lambda table, start_day, end_day: dict(modified),
+                    'sketches', 4, force)
+
+    reads = []
+    read_percentiles(reads)('t', 'a', '2017-09-01', '2017-09-03')
+    assert reads == [('2017-09-01', '2017-09-03')]
+
+    reads = []
+    read_percentiles(reads)('t', 'a', '2017-09-01', '2017-09-03')
+    assert reads == []
+
+    modified[20170902] = '2'
+    reads = []
+    read_percentiles(reads)('t', 'a', '2017-09-01', '2017-09-03')
+    assert reads == [('2017-09-02', '2017-09-02')]
+
+    reads = []
+    read_percentiles(reads, force=True)('t', 'a', '2017-09-01', '2017-09-03')
+    assert reads == [('2017-09-01', '2017-09-03')]
+    assert len(pd.read_csv('sketches/t.a.csv', header=None)) == 3
@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+import db_dist
+import db_stats_diff
+
+
+def _distinct_pair(rs_count, bq_count):
+    return pd.DataFrame({'distinct_count_rs': [rs_count],
+                         'distinct_error_rs': [db_dist._rs_approx_distinct_error],
+                         'distinct_count_bq': [bq_count],
+                         'distinct_error_bq': [db_dist._bq_approx_distinct_error]})
+
+
+# the tolerance of 1000 rs is 1000 * 0.02 + bq * 0.0172
+@pytest.mark.parametrize('bq_count, match', [
+    (1037, True),   # 37 <= 37.84
+    (1038, False),  # 38 >  37.85
+    (964, True),    # 36 <= 36.58
+    (963, False),   # 37 >  36.56
+    ])
+def test_approx_distinct_counts_match_within_both_errors(bq_count, match):
+    assert db_stats_diff.is_distinct_match(_distinct_pair(1000, bq_count))[0] == match
+
+
+def test_exact_distinct_counts_must_be_equal():
+    df = _distinct_pair(1000, 1001)
+    df['distinct_error_rs'] = 0.0
+    df['distinct_error_bq'] = 0.0
+    assert not db_stats_diff.is_distinct_match(df)[0]